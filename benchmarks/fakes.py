@@ -0,0 +1,356 @@
+"""
+ロードテスト(loadtest.py)用の、Slack Web APIとGoogle Sheetsのローカルのフェイク。
+どちらもAPIの呼び出し回数をメソッドごとに数え、指定した遅延(ネットワークの往復の代わり)を入れて応答する。
+"""
+import json
+import time
+import itertools
+import threading
+from collections import Counter, defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+class CallCounter:
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.counts = Counter()
+        self.lock = threading.Lock()
+
+    def call(self, method):
+        with self.lock:
+            self.counts[method] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+
+class FakeSlackState:
+    """フェイクのSlackワークスペース。ユーザー、チャンネル、チャンネルのメッセージを持つ。"""
+
+    def __init__(self):
+        self.users = {}
+        self.channels = {}
+        self.messages = {}
+        self.lock = threading.Lock()
+        self.ts = itertools.count(1)
+
+    def next_ts(self):
+        # 単調増加するts。実際のSlackと同じく小数点以下6桁。
+        n = next(self.ts)
+        return f"{1700000000 + n // 1000000}.{n % 1000000:06d}"
+
+    def add_user(self, user_id, email, name):
+        self.users[user_id] = {
+            "id": user_id,
+            "name": name,
+            "deleted": False,
+            "profile": {"email": email, "display_name": name, "real_name": name},
+        }
+
+    def add_channel(self, channel_id, name, members=()):
+        self.channels[channel_id] = {"id": channel_id, "name": name, "members": set(members)}
+        self.messages[channel_id] = []
+
+    def add_message(self, channel_id, user_id, text):
+        with self.lock:
+            message = {"type": "message", "user": user_id, "text": text, "ts": self.next_ts()}
+            self.messages.setdefault(channel_id, []).append(message)
+        return message
+
+
+def rate_limit_violations(accepted: dict, per_minute_of, tolerance=1):
+    """
+    受け付けたリクエストの時刻から、トークンバケット(容量 per_minute // 10, 毎秒 per_minute / 60)を超えた区間を探す。
+    時刻のずれを考慮して、tolerance件までの超過は許す。
+
+    Returns:
+        {バケット: 最も超過した区間のリクエスト数と上限}
+    """
+    violations = {}
+    for key, times in accepted.items():
+        per_minute = per_minute_of(key.split(":", 1)[0])
+        capacity, rate = max(1, per_minute // 10), per_minute / 60
+        worst = None
+        for i in range(len(times)):
+            for j in range(i, len(times)):
+                count, allowed = j - i + 1, capacity + rate * (times[j] - times[i]) + tolerance
+                if count > allowed and (worst is None or count - allowed > worst[0] - worst[1]):
+                    worst = (count, allowed)
+        if worst is not None:
+            violations[key] = dict(requests=worst[0], allowed=round(worst[1], 1))
+    return violations
+
+
+def paginate(items, params, default_limit=100):
+    offset = int(params.get("cursor") or 0)
+    limit = int(params.get("limit") or default_limit)
+    page = items[offset:offset + limit]
+    next_cursor = str(offset + limit) if offset + limit < len(items) else ""
+    return page, {"next_cursor": next_cursor}
+
+
+class FakeRateLimits:
+    """
+    429モード。メソッドごと(chat.postMessageはチャンネルごと)のトークンバケットで制限し、
+    超えたリクエストには実際のSlackと同じく429とRetry-Afterを返す。受け付けたリクエストの時刻も記録する。
+    enforce=Falseの場合は制限せず、時刻の記録だけを行う。
+    """
+
+    def __init__(self, per_minute: dict, default_per_minute, enforce=True, jitter=0.25):
+        self.enforce = enforce
+        # クライアントとこのサーバーの時刻のずれ(秒)。このぶん早く届いたリクエストは受け付ける。
+        self.jitter = jitter
+        self.per_minute = per_minute
+        self.default_per_minute = default_per_minute
+        self.buckets = {}
+        self.accepted = defaultdict(list)
+        self.rejected = Counter()
+        self.lock = threading.Lock()
+
+    def bucket_key(self, method, params):
+        if method == "chat.postMessage" and params.get("channel"):
+            return f"{method}:{params['channel']}"
+        return method
+
+    def limit(self, method):
+        return self.per_minute.get(method, self.default_per_minute)
+
+    def check(self, method, params):
+        """受け付ける場合はNone、制限を超えた場合はRetry-Afterの秒数を返す。"""
+        per_minute = self.limit(method)
+        capacity, rate = max(1, per_minute // 10), per_minute / 60
+        key = self.bucket_key(method, params)
+        now = time.monotonic()
+        with self.lock:
+            tokens, ts = self.buckets.get(key, (capacity, now))
+            tokens = min(capacity, tokens + (now - ts) * rate)
+            if tokens + self.jitter * rate < 1 and self.enforce:
+                self.buckets[key] = (tokens, now)
+                self.rejected[method] += 1
+                return max(1, int((1 - tokens) / rate + 0.999))
+            self.buckets[key] = (tokens - 1, now)
+            self.accepted[key].append(now)
+        return None
+
+
+class FakeSlackHandler(BaseHTTPRequestHandler):
+    server_version = "FakeSlack/1.0"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _params(self):
+        params = {key: values[-1] for key, values in parse_qs(urlparse(self.path).query).items()}
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length).decode() if length else ""
+        if body:
+            if "json" in (self.headers.get("Content-Type") or ""):
+                params.update(json.loads(body))
+            else:
+                params.update({key: values[-1] for key, values in parse_qs(body).items()})
+        return params
+
+    def do_POST(self):
+        method = urlparse(self.path).path.rsplit("/", 1)[-1]
+        params = self._params()
+        retry_after = self.server.rate_limits.check(method, params) if self.server.rate_limits else None
+        if retry_after is not None:
+            self._respond(429, {"ok": False, "error": "ratelimited"}, {"Retry-After": str(retry_after)})
+            return
+        self.server.counter.call(method)
+        self._respond(200, self.server.dispatch(method, params))
+
+    def _respond(self, status, response, headers=None):
+        payload = json.dumps(response).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(payload)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    do_GET = do_POST
+
+
+class FakeSlackServer(ThreadingHTTPServer):
+    """
+    Slack Web APIのフェイク。SLACK_API_URLを url に向けると、WebClient・AsyncWebClientはこのサーバーを呼ぶ。
+    ロードテストで使うメソッドだけを実装し、それ以外は {"ok": true} を返す。rate_limitsを渡すと429モードになる。
+    """
+    daemon_threads = True
+
+    def __init__(self, state: FakeSlackState, bot_id, latency=0.0, rate_limits: FakeRateLimits = None):
+        super().__init__(("127.0.0.1", 0), FakeSlackHandler)
+        self.state = state
+        self.bot_id = bot_id
+        self.counter = CallCounter(latency)
+        self.rate_limits = rate_limits
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}/api/"
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, name="fake-slack", daemon=True).start()
+        return self
+
+    def dispatch(self, method, params):
+        state = self.state
+        if method == "auth.test":
+            return {"ok": True, "user_id": self.bot_id, "bot_id": "B_BENCH", "team_id": "T_BENCH"}
+        if method == "users.list":
+            members, metadata = paginate(list(state.users.values()), params, default_limit=200)
+            return {"ok": True, "members": members, "response_metadata": metadata}
+        if method == "users.info":
+            user = state.users.get(params.get("user"))
+            return {"ok": True, "user": user} if user else {"ok": False, "error": "user_not_found"}
+        if method == "users.lookupByEmail":
+            for user in state.users.values():
+                if user["profile"]["email"].lower() == params.get("email", "").lower():
+                    return {"ok": True, "user": user}
+            return {"ok": False, "error": "users_not_found"}
+        if method == "conversations.list":
+            channels = [{"id": c["id"], "name": c["name"]} for c in state.channels.values()]
+            channels, metadata = paginate(channels, params, default_limit=1000)
+            return {"ok": True, "channels": channels, "response_metadata": metadata}
+        if method == "conversations.members":
+            channel = state.channels.get(params.get("channel"))
+            if channel is None:
+                return {"ok": False, "error": "channel_not_found"}
+            members, metadata = paginate(sorted(channel["members"]), params, default_limit=1000)
+            return {"ok": True, "members": members, "response_metadata": metadata}
+        if method == "conversations.invite":
+            channel = state.channels.get(params.get("channel"))
+            if channel is None:
+                return {"ok": False, "error": "channel_not_found"}
+            users = set(params.get("users", "").split(","))
+            if users & channel["members"]:
+                return {"ok": False, "error": "already_in_channel"}
+            channel["members"] |= users
+            return {"ok": True, "channel": {"id": channel["id"]}}
+        if method == "conversations.open":
+            return {"ok": True, "channel": {"id": f"D{params.get('users')}"}}
+        if method == "conversations.history":
+            messages = state.messages.get(params.get("channel"), [])
+            oldest = params.get("oldest")
+            if oldest:
+                messages = [m for m in messages if float(m["ts"]) > float(oldest)]
+            # 実際のAPIと同じく新しい順
+            messages, metadata = paginate(list(reversed(messages)), params, default_limit=100)
+            return {"ok": True, "messages": messages, "has_more": bool(metadata["next_cursor"]), "response_metadata": metadata}
+        if method == "chat.postMessage":
+            message = state.add_message(params.get("channel"), self.bot_id, params.get("text") or "")
+            message["subtype"] = "bot_message"
+            return {"ok": True, "channel": params.get("channel"), "ts": message["ts"], "message": message}
+        if method == "chat.postEphemeral":
+            return {"ok": True, "message_ts": state.next_ts()}
+        if method == "views.open":
+            return {"ok": True, "view": {"id": "V_BENCH"}}
+        return {"ok": True}
+
+
+class FakeSpreadsheet:
+    """gspread.Spreadsheetのうち、GSheetClientWrapperが使うメソッドだけを持つフェイク。"""
+
+    def __init__(self, key, counter: CallCounter):
+        self.id = key
+        self.url = f"https://docs.google.com/spreadsheets/d/{key}"
+        self.client = None
+        self.counter = counter
+        self.sheets = {}
+        self.permissions = []
+        self.lock = threading.Lock()
+
+    def add_records_worksheet(self, title, records):
+        self.sheets[title] = FakeWorksheet(self, title, len(self.sheets), records)
+
+    def worksheets(self):
+        self.counter.call("spreadsheets.get")
+        return list(self.sheets.values())
+
+    def fetch_sheet_metadata(self, params=None):
+        self.counter.call("spreadsheets.get")
+        return {"sheets": [{"properties": {"sheetId": s.id, "title": s.title}, "protectedRanges": []} for s in self.sheets.values()]}
+
+    def batch_update(self, body):
+        self.counter.call("spreadsheets.batchUpdate")
+        replies = []
+        with self.lock:
+            for request in body["requests"]:
+                if "addSheet" in request:
+                    properties = dict(request["addSheet"]["properties"], index=len(self.sheets))
+                    self.sheets[properties["title"]] = FakeWorksheet(self, properties["title"], properties["sheetId"], [])
+                    replies.append({"addSheet": {"properties": properties}})
+                else:
+                    replies.append({})
+        return {"spreadsheetId": self.id, "replies": replies}
+
+    def list_permissions(self):
+        self.counter.call("drive.permissions.list")
+        return list(self.permissions)
+
+    def share(self, email, **kwargs):
+        self.counter.call("drive.permissions.create")
+        self.permissions.append({"emailAddress": email})
+
+
+class FakeWorksheet:
+    def __init__(self, spreadsheet, title, sheet_id, records):
+        self.spreadsheet = spreadsheet
+        self.title = title
+        self.id = sheet_id
+        self.records = records
+
+    def get_all_records(self):
+        self.spreadsheet.counter.call("values.get")
+        return [dict(record) for record in self.records]
+
+    def batch_update(self, data, value_input_option=None):
+        self.spreadsheet.counter.call("values.batchUpdate")
+        return {"totalUpdatedCells": len(data)}
+
+
+def make_fake_gsheet_client(spreadsheets, latency=0.0):
+    """
+    GSheetClientWrapperのうち、Google APIを呼ぶ部分だけをフェイクに差し替えたクライアントを返す。
+    Masterのインデックス作成、batchUpdateのリクエスト組み立て、共有済みemailのキャッシュなどは実際のコードが動く。
+    """
+    from src.app.gsheet import GSheetClientWrapper
+    from src.app.metrics import instrument_methods
+    from src.db.cache import SharedValueCache
+    import setting
+
+    @instrument_methods("gsheet", ["open_spreadsheet", "batch_share_spreadsheet"])
+    class FakeGSheetClient(GSheetClientWrapper):
+        def __init__(self):
+            self.counter = CallCounter(latency)
+            self.fake_spreadsheets = spreadsheets
+            for spreadsheet in spreadsheets.values():
+                spreadsheet.counter = self.counter
+            self.master_index_cache = SharedValueCache("gsheet:master_index", ttl=setting.MASTER_SHEET_CACHE_TTL)
+            self.case_index_cache = SharedValueCache("gsheet:case_index", ttl=setting.CASE_SHEET_CACHE_TTL)
+            self.spreadsheets = {}
+            self.worksheets = {}
+
+        def refresh_token_if_needed(self):
+            pass
+
+        def open_spreadsheet(self, key):
+            if key not in self.spreadsheets:
+                self.counter.call("spreadsheets.get")
+                self.spreadsheets[key] = self.fake_spreadsheets[key]
+            return self.spreadsheets[key]
+
+        def batch_share_spreadsheet(self, sheet, emails):
+            self.counter.call("drive.batch")
+            sheet.permissions.extend({"emailAddress": email} for email in emails)
+            return list(emails)
+
+    return FakeGSheetClient()
+
+
+def install_fake_gsheet_client(client):
+    """get_gsheet_client()がフェイクのクライアントを返すようにする。"""
+    from src.app import gsheet
+    gsheet._gsheet_client = client
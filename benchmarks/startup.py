@@ -0,0 +1,72 @@
+"""
+webプロセス(main.py)とCeleryワーカー(src.app.worker)の起動時間を測る。
+毎回新しいPythonプロセスでモジュールをimportして、importにかかった時間と、読み込まれた重いモジュールを表示する。
+
+    SECRETS_DIR=./secrets python benchmarks/startup.py --repeat 10
+    SECRETS_DIR=./secrets python benchmarks/startup.py --importtime   # 時間のかかったimportの上位を表示する
+
+.envとsecretsが読める環境で実行する。importだけなので、Slack・Redis・MySQLには接続しない。
+"""
+import os
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+ENTRY_POINTS = {
+    "web": "main",
+    "worker": "src.app.worker",
+}
+HEAVY_MODULES = ["pandas", "numpy", "gspread", "google.oauth2", "celery", "sqlalchemy", "slack_bolt"]
+
+MEASURE_SCRIPT = """
+import sys, time, json
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+print(json.dumps({{"elapsed": elapsed, "loaded": [name for name in {heavy!r} if name in sys.modules]}}))
+"""
+
+
+def measure(module):
+    script = MEASURE_SCRIPT.format(module=module, heavy=HEAVY_MODULES)
+    output = subprocess.run([sys.executable, "-c", script], cwd=ROOT, check=True, capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def import_times(module, top):
+    """python -X importtimeの結果から、累積時間の大きいimportを返す。"""
+    stderr = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"], cwd=ROOT, check=True, capture_output=True, text=True).stderr
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = [part.strip() for part in line[len("import time:"):].split("|")]
+        rows.append((int(cumulative), name.strip()))
+    return sorted(rows, reverse=True)[:top]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--entry", choices=list(ENTRY_POINTS), action="append")
+    parser.add_argument("--importtime", action="store_true")
+    parser.add_argument("--top", type=int, default=15)
+    args = parser.parse_args()
+
+    for entry in args.entry or list(ENTRY_POINTS):
+        module = ENTRY_POINTS[entry]
+        results = [measure(module) for _ in range(args.repeat)]
+        elapsed = [result["elapsed"] * 1000 for result in results]
+        print(f"{entry} ({module}): median {statistics.median(elapsed):.0f}ms, min {min(elapsed):.0f}ms, max {max(elapsed):.0f}ms (n={args.repeat})")
+        print(f"  loaded: {', '.join(results[-1]['loaded']) or '-'}")
+        if args.importtime:
+            for cumulative, name in import_times(module, args.top):
+                print(f"  {cumulative / 1000:8.1f}ms  {name}")
+
+
+if __name__ == "__main__":
+    main()
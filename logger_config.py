@@ -1,20 +1,165 @@
 import os
+import copy
+import json
+import time
+import queue
 import logging
-from datetime import datetime, timezone, timedelta
+import threading
+import functools
+import billiard.process
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 from src.app.slack import SlackLoggingHandler
+from src.app.utils import reset_in_forked_child
 import setting
 
-def setup_loggers(logger):
-    logger.setLevel(logging.DEBUG)
-    logging.Formatter.converter = lambda *args: datetime.now(tz=timezone(timedelta(hours=+9), 'JST')).timetuple()
+JST_OFFSET_SECONDS = 9 * 60 * 60
+TEXT_FORMAT = '%(asctime)s %(levelname)-9s [%(pathname)s:%(lineno)d - %(funcName)s] %(message)s'
+# Slackのリクエストbodyのうち、ログに残すキー
+SUMMARY_KEYS = ("type", "command", "text", "channel_id", "channel_name", "user_id", "callback_id")
+
+
+@functools.lru_cache(maxsize=8)
+def _jst_timetuple(seconds):
+    return time.gmtime(seconds + JST_OFFSET_SECONDS)
+
+
+def jst_converter(secs=None):
+    """logging.Formatter.converterの代わり。同じ秒のレコードは変換結果を使い回す。"""
+    return _jst_timetuple(int(time.time() if secs is None else secs))
+
+
+class JsonFormatter(logging.Formatter):
+    """1レコードを1行のJSONにする。"""
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "location": f"{record.pathname}:{record.lineno}",
+            "func": record.funcName,
+            "process": record.process,
+            "message": record.getMessage(),
+        }
+        if record.exc_text:
+            entry["exc_info"] = record.exc_text
+        elif record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class summarize:
+    """
+    Slackのリクエストbodyを、ログ用に主要なキーだけにする。
+    `logger.debug("body: %s", summarize(body))` のように渡すと、出力されるときまで変換を遅らせられる。
+    """
+
+    def __init__(self, payload):
+        self.payload = payload
+
+    def __str__(self):
+        payload = self.payload
+        if not isinstance(payload, dict):
+            return str(payload)
+        summary = {key: payload[key] for key in SUMMARY_KEYS if key in payload}
+        for key in ("user", "channel", "view"):
+            if isinstance(payload.get(key), dict):
+                summary[f"{key}_id"] = payload[key].get("id")
+        if payload.get("actions"):
+            summary["action_ids"] = [action.get("action_id") for action in payload["actions"]]
+        return str(summary)
+
 
-    os.makedirs(setting.LOG_DIR, exist_ok=True)
-    file_handler = logging.FileHandler(f'{setting.LOG_DIR}/app.log')
-    file_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)-9s [%(pathname)s:%(lineno)d - %(funcName)s] %(message)s'))
-    logger.addHandler(file_handler)
+class FileLogQueueHandler(QueueHandler):
+    """
+    ファイルへの書き込みをQueueListenerのスレッドで行うハンドラ。
+    Celeryのワーカーはforkされるので、子プロセスでは別のファイル(app.<サービス名>.<プロセス番号>.log)に書き込むリスナーを作り直す。
+    (同じファイルを複数のプロセスがローテーションすると、ログが上書きされるため)
+    プロセス番号はpoolの中での番号(0〜concurrency-1)なので、子プロセスが作り直されてもファイルは増えない。
+    """
 
-    slack_handler = SlackLoggingHandler()
-    slack_handler.setFormatter(logging.Formatter('%(message)s'))
-    logger.addHandler(slack_handler)
+    def __init__(self, filename, formatter, level):
+        super().__init__(queue.SimpleQueue())
+        self.setLevel(level)
+        self.filename = filename
+        self.file_formatter = formatter
+        self.forked = False
+        self.listener = None
+        self.listener_lock = threading.Lock()
+        reset_in_forked_child(self._reset)
 
+    def _reset(self):
+        # リスナーのスレッドは子プロセスに引き継がれないので、最初のログで子プロセス用のファイルに作り直す。
+        self.forked = True
+        self.listener = None
+        self.listener_lock = threading.Lock()
+
+    def _start_listener(self):
+        with self.listener_lock:
+            if self.listener is not None:
+                return
+            filename = self.filename
+            if self.forked:
+                # Celery(billiard)のpool以外でforkされた場合は番号がないので、pidで区別する。
+                index = getattr(billiard.process.current_process(), "index", None)
+                root, ext = os.path.splitext(self.filename)
+                filename = f"{root}.{os.getpid() if index is None else index}{ext}"
+            file_handler = RotatingFileHandler(filename, maxBytes=setting.LOG_FILE_MAX_BYTES, backupCount=setting.LOG_FILE_BACKUP_COUNT, encoding="utf-8")
+            file_handler.setFormatter(self.file_formatter)
+            self.queue = queue.SimpleQueue()
+            listener = QueueListener(self.queue, file_handler)
+            listener.start()
+            self.listener = listener
+
+    def enqueue(self, record):
+        if self.listener is None:
+            self._start_listener()
+        self.queue.put_nowait(record)
+
+    def prepare(self, record):
+        # 引数のオブジェクトは後から変更され得るので、メッセージとトレースバックだけはここで文字列にする。
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def close(self):
+        if self.listener is not None:
+            self.listener.stop()
+            for handler in self.listener.handlers:
+                handler.close()
+            self.listener = None
+        super().close()
+
+
+_handlers = None
+
+
+def get_handlers():
+    """ファイル・Slackのハンドラを、プロセスで1つずつだけ作る。"""
+    global _handlers
+    if _handlers is None:
+        logging.Formatter.converter = staticmethod(jst_converter)
+        os.makedirs(setting.LOG_DIR, exist_ok=True)
+        file_formatter = JsonFormatter() if setting.LOG_FORMAT == "json" else logging.Formatter(TEXT_FORMAT)
+        file_handler = FileLogQueueHandler(f'{setting.LOG_DIR}/app.{setting.LOG_SERVICE_NAME}.log', file_formatter, setting.LOG_FILE_LEVEL)
+
+        slack_handler = SlackLoggingHandler()
+        slack_handler.setLevel(setting.LOG_SLACK_LEVEL)
+        slack_handler.setFormatter(logging.Formatter('%(message)s'))
+        _handlers = [file_handler, slack_handler]
+    return _handlers
+
+
+def setup_loggers(logger):
+    handlers = get_handlers()
+    # 全てのハンドラで出力しないレベルは、loggerの段階で捨てる(メッセージの組み立ても行われない)。
+    logger.setLevel(min(handler.level for handler in handlers))
+    for handler in handlers:
+        if handler not in logger.handlers:
+            logger.addHandler(handler)
     return logger
@@ -1,35 +1,54 @@
 import json
+import time
+import asyncio
 import logging
+import redis
 from slack_sdk import WebClient
+from slack_sdk.web.async_client import AsyncWebClient
 from slack_bolt.async_app import AsyncApp
 from slack_bolt.adapter.socket_mode.async_handler import AsyncSocketModeHandler
 from src.app.messages import ask_reason_block
 import setting
-from src.app.worker import save_messages_task, invite_players_task, start_task, on_open_spreadsheet_task, on_annotation_done_task
-from src.db.game_info import GameInfoDB
-from logger_config import setup_loggers
-from src.app.messages import access_denied_message, no_game_info_message, game_not_started_message, wrong_user_message
+# タスクの実装(pandas, gspreadなど)は読み込まず、タスク名で送る。
+from src.app.celery_app import celery, send_task
+from src.db.game_info import AsyncGameInfoDB
+from src.db.cache import get_async_redis, MessageCaptureSession
+from src.app.slack import USER_CHANGE_CHANNEL, MEMBERSHIP_CHANGE_CHANNEL
+from src.app.ratelimit import AsyncSharedRateLimitErrorRetryHandler
+from src.app.metrics import metrics, render_prometheus
+from logger_config import setup_loggers, summarize
+from src.app.messages import access_denied_message, no_game_info_message, game_not_started_message, wrong_user_message, export_queued_message, export_running_message
 
-game_info_db = GameInfoDB().get_instance()
+game_info_db = AsyncGameInfoDB.get_instance()
+message_capture = MessageCaptureSession()
 
 app = AsyncApp(
-    token=setting.SLACK_BOT_TOKEN,
+    client=AsyncWebClient(token=setting.SLACK_BOT_TOKEN, base_url=setting.SLACK_API_URL),
     signing_secret=setting.SLACK_SIGNING_SECRET,
 )
+app.client.retry_handlers.append(AsyncSharedRateLimitErrorRetryHandler(max_retry_count=setting.SLACK_RATE_LIMIT_MAX_RETRIES))
     
 logger = logging.getLogger(__name__)
 logger = setup_loggers(logger)
 
+# チャンネルごとのsave_messages_taskのjob_idと送った時刻(Redisのハッシュ)。エクスポート中かどうかの確認に使う。
+EXPORT_JOB_KEY_PREFIX = "export_job:"
+EXPORT_RUNNING_STATES = ("PENDING", "RECEIVED", "STARTED", "RETRY")
+# 送ってからこれより時間が経ったジョブは、状態に関わらず終わったとみなす。
+# (PENDINGは存在しない・期限切れのjob_idでも返り、ワーカーが強制終了されたタスクはSTARTEDのまま残るため)
+# hardの時間制限に、キューで待つ時間の余裕を足す。
+EXPORT_JOB_TTL = setting.CELERY_EXPORT_TIME_LIMIT + 120
+
 
 # validation
 async def validate_command_usage(body, client: WebClient):
     channel_id = body.get("channel_id")
     invoked_user_id = body.get("user_id")
     command = body.get("command")
-    game_info = game_info_db.get_game_info(channel_id)
-    logger.debug(f"validate_command_usage, channel_id: {channel_id}, invoked_user_id: {invoked_user_id}, command: {command}, game_info: {game_info}")
+    game_info = await game_info_db.get_game_info(channel_id)
+    logger.debug("validate_command_usage, channel_id: %s, invoked_user_id: %s, command: %s, game_info: %s", channel_id, invoked_user_id, command, game_info)
     
-    if command == "/invite_players" or command == "/start":
+    if command in ("/invite_players", "/start", "/reload_master"):
         if invoked_user_id not in setting.STAFF_BOT_IDS:
             await client.chat_postEphemeral(channel=channel_id, user=invoked_user_id, text=access_denied_message(invoked_user_id))
             return False
@@ -56,34 +75,79 @@ async def validate_command_usage(body, client: WebClient):
 async def handle_invite_command(ack, body, client):
     try:
         await ack()
-        logger.debug(f"/invite_players, body: {body}")
+        logger.debug("/invite_players, body: %s", summarize(body))
         if await validate_command_usage(body=body, client=client):
-            invite_players_task.delay(body)
+            # `/invite_players all` やチャンネル名を指定した場合は、一括で招待する。
+            if body.get("text", "").strip():
+                send_task("invite_players_bulk_task", body)
+            else:
+                send_task("invite_players_task", body)
     except Exception as e:
-        logger.error(f"Failed to invite players: {e}")
+        logger.error("Failed to invite players: %s", e)
 
 
 @app.command("/start")
 async def handle_start_command(ack, body, client):
     try:
         await ack()
-        logger.debug(f"/start, body: {body}")
+        logger.debug("/start, body: %s", summarize(body))
+        if await validate_command_usage(body=body, client=client):
+            send_task("start_task", body)
+    except Exception as e:
+        logger.error("Failed to start: %s", e)
+
+
+@app.command("/reload_master")
+async def handle_reload_master_command(ack, body, client):
+    try:
+        await ack()
+        logger.debug("/reload_master, body: %s", summarize(body))
         if await validate_command_usage(body=body, client=client):
-            start_task.delay(body)
+            send_task("reload_master_task", body)
     except Exception as e:
-        logger.error(f"Failed to start: {e}")
+        logger.error("Failed to reload master sheet: %s", e)
 
 
 async def open_ask_reason_modal(client, trigger_id, channel_id, judge):
     modal_view = ask_reason_block(channel_id, judge)
     response = await client.views_open(trigger_id=trigger_id, view=modal_view)
-    logger.debug(f"views.open response: {response}")
+    logger.debug("views.open response: %s", response)
+
+
+async def get_running_export_job(channel_id):
+    try:
+        job = await get_async_redis().hgetall(f"{EXPORT_JOB_KEY_PREFIX}{channel_id}")
+    except redis.RedisError as e:
+        logger.warning("Failed to read export job of <#%s>: %s", channel_id, e)
+        return None
+    if not job or time.time() - float(job["submitted_at"]) > EXPORT_JOB_TTL:
+        return None
+    # result backendへの問い合わせはブロッキングなので、イベントループの外で行う。
+    state = await asyncio.to_thread(lambda: celery.AsyncResult(job["job_id"]).state)
+    return job["job_id"] if state in EXPORT_RUNNING_STATES else None
 
 
-# 客役のjudgeを受け取り、Googleスプレットシートに保存して、ユーザーにURLを返して、入力を促す。
+# 客役のjudgeを受け取り、Celeryのワーカーでスプレットシートに保存して、ユーザーにURLを返して、入力を促す。
 async def save_messages(body, judge, reason):
-    logger.debug(f"/{judge}, reason: {reason}, body: {body}")
-    save_messages_task(body, judge, reason)
+    logger.debug("/%s, reason: %s, body: %s", judge, reason, summarize(body))
+    result = send_task("save_messages_task", body, judge, reason)
+    key = f"{EXPORT_JOB_KEY_PREFIX}{body['channel_id']}"
+    try:
+        pipe = get_async_redis().pipeline(transaction=True)
+        pipe.hset(key, mapping=dict(job_id=result.id, submitted_at=time.time()))
+        pipe.expire(key, EXPORT_JOB_TTL)
+        await pipe.execute()
+    except redis.RedisError as e:
+        logger.warning("Failed to record export job of <#%s>: %s", body["channel_id"], e)
+    return result.id
+
+
+async def notify_if_export_running(client, channel_id, user_id):
+    job_id = await get_running_export_job(channel_id)
+    if job_id is None:
+        return False
+    await client.chat_postEphemeral(channel=channel_id, user=user_id, text=export_running_message(user_id, job_id))
+    return True
 
 
 @app.command("/lie")
@@ -91,7 +155,9 @@ async def handle_lie_command(ack, body, client):
     await ack()
     judge = "lie"
     channel_id = body.get("channel_id")
-    if await validate_command_usage(body, client):    
+    if await validate_command_usage(body, client):
+        if await notify_if_export_running(client, channel_id, body.get("user_id")):
+            return
         await open_ask_reason_modal(client, body.get("trigger_id"), channel_id=channel_id, judge=judge)
 
 
@@ -101,11 +167,13 @@ async def handle_trust_command(ack, body, client):
     judge = "trust"
     channel_id = body.get("channel_id")
     if await validate_command_usage(body, client):
+        if await notify_if_export_running(client, channel_id, body.get("user_id")):
+            return
         await open_ask_reason_modal(client, body.get("trigger_id"), channel_id=channel_id, judge=judge)
 
 
 @app.view("message_submission")
-async def handle_view_submission(ack, body, view):
+async def handle_view_submission(ack, body, view, client):
     await ack()
     reason = view["state"]["values"]["message_input_block"]["message"]["value"]
     # TODO; 入力のチェックをする
@@ -115,39 +183,147 @@ async def handle_view_submission(ack, body, view):
     body["channel_id"] = channel_id
     body["user_id"] = body["user"]["id"]
     body["command"] = judge
-    logger.debug(f"view_submission, body: {body}, view: {view}, reason: {reason}, judge: {judge}, channel_id: {channel_id}")
+    logger.debug("view_submission, body: %s, view: %s, reason: %s, judge: %s, channel_id: %s", summarize(body), summarize(view), reason, judge, channel_id)
 
-    await save_messages(body, judge, reason)
+    if await notify_if_export_running(client, channel_id, body["user_id"]):
+        return
+    job_id = await save_messages(body, judge, reason)
+    await client.chat_postEphemeral(channel=channel_id, user=body["user_id"], text=export_queued_message(body["user_id"], job_id))
 
 
 @app.action("open_spreadsheet")
 async def on_open_spreadsheet(body, ack):
     await ack()
-    game_info = game_info_db.get_game_info(body.get("channel").get("id"))
-    logger.debug(f"on_open_spreadsheet_task, body: {body}, action_id: {body.get('actions')[0].get('action_id')}")
+    game_info = await game_info_db.get_game_info(body.get("channel").get("id"))
+    logger.debug("on_open_spreadsheet_task, body: %s, action_id: %s", summarize(body), body.get('actions')[0].get('action_id'))
     invoked_user_id = body['user']['id']
     if invoked_user_id == game_info.customer_id and invoked_user_id not in setting.STAFF_BOT_IDS:
-        logger.debug(f"invoke_user_id: {invoked_user_id}, sales_id: {game_info.sales_id}, is_liar: {game_info.is_liar}")
-        on_open_spreadsheet_task.delay(body)
+        logger.debug("invoke_user_id: %s, sales_id: %s, is_liar: %s", invoked_user_id, game_info.sales_id, game_info.is_liar)
+        send_task("on_open_spreadsheet_task", body)
     elif invoked_user_id == game_info.sales_id and game_info.is_liar:
-        logger.debug(f"invoke_user_id: {invoked_user_id}, sales_id: {game_info.sales_id}, is_liar: {game_info.is_liar}")
-        on_open_spreadsheet_task.delay(body)
+        logger.debug("invoke_user_id: %s, sales_id: %s, is_liar: %s", invoked_user_id, game_info.sales_id, game_info.is_liar)
+        send_task("on_open_spreadsheet_task", body)
 
 
 @app.action("annotation_done")
 async def on_annotation_done(body, ack):
     await ack()
     action_id = body.get("actions")[0].get("action_id")
-    logger.debug(f"on_annotation_done_task, body: {body}, action_id: {action_id}")
+    logger.debug("on_annotation_done_task, body: %s, action_id: %s", summarize(body), action_id)
     
-    on_annotation_done_task.delay(body)
+    send_task("on_annotation_done_task", body)
+
+
+# 客役・営業役のメッセージを記録しておき、エクスポート時にconversations_historyを読まなくて済むようにする。
+@app.event("message")
+async def on_message(event):
+    subtype = event.get("subtype")
+    if subtype not in (None, "message_changed", "message_deleted"):
+        return
+    channel_id = event.get("channel")
+    game_info = await game_info_db.get_game_info(channel_id)
+    # /start前のやりとりは対話に含めない。
+    if game_info is None or not game_info.is_started:
+        return
+
+    if subtype == "message_deleted":
+        await game_info_db.delete_message(channel_id, event.get("deleted_ts"))
+        return
+    if subtype == "message_changed":
+        event = event["message"]
+    # conversations_historyと同じく、スレッドの返信は含めない。
+    if event.get("thread_ts") not in (None, event["ts"]):
+        return
+    user_id = event.get("user")
+    if user_id == game_info.customer_id:
+        role = "customer"
+    elif user_id == game_info.sales_id:
+        role = "sales"
+    else:
+        return
+    await game_info_db.save_message(channel_id=channel_id, ts=event["ts"], user_id=user_id, role=role, text=event.get("text"))
+
+
+# プロフィールの変更をワーカーのプロフィールキャッシュに伝える。
+@app.event("user_change")
+async def on_user_change(event):
+    await get_async_redis().publish(USER_CHANGE_CHANNEL, json.dumps(event["user"]))
+
+
+# メンバー・チャンネルの変更をワーカーのキャッシュに伝える。
+@app.event("member_joined_channel")
+@app.event("channel_created")
+@app.event("team_join")
+async def on_membership_change(event):
+    membership_change = dict(type=event["type"])
+    if event["type"] == "member_joined_channel":
+        membership_change["channel"] = event.get("channel")
+    elif event["type"] == "team_join":
+        membership_change["user"] = event.get("user")
+    await get_async_redis().publish(MEMBERSHIP_CHANGE_CHANNEL, json.dumps(membership_change))
+
+
+async def start_metrics_server():
+    """ワーカーが記録した集計(Redis)を、/metricsでPrometheusのテキスト形式で返す。"""
+    from aiohttp import web
+
+    async def handle_metrics(request):
+        text = await asyncio.to_thread(render_prometheus)
+        return web.Response(text=text, content_type="text/plain", charset="utf-8")
+
+    metrics_app = web.Application()
+    metrics_app.router.add_get("/metrics", handle_metrics)
+    runner = web.AppRunner(metrics_app)
+    await runner.setup()
+    await web.TCPSite(runner, port=setting.METRICS_PORT).start()
+
+
+async def flush_metrics_periodically(interval=setting.METRICS_FLUSH_INTERVAL):
+    """webプロセスで記録した値を、定期的にRedisに送る(metrics.flushはブロッキングなのでスレッドで行う)。"""
+    while True:
+        await asyncio.sleep(interval)
+        await asyncio.to_thread(metrics.flush)
+
+
+async def keep_message_capture_session(client, interval=setting.MESSAGE_CAPTURE_HEARTBEAT_INTERVAL):
+    """
+    Socket Modeで接続している間はMessageCaptureSessionを延長し、切断・再接続したら新しいセッションにする。
+    切断していた間のmessageイベントは記録できていないので、それ以前に開始したゲームはSlackから読むことになる。
+    """
+    session_id = None
+
+    async def on_close(message):
+        nonlocal session_id
+        session_id = None
+        await message_capture.end()
+
+    client.on_close_listeners.append(on_close)
+    while True:
+        try:
+            if not await client.is_connected():
+                if session_id is not None:
+                    logger.warning("Socket Mode connection lost; ending message capture session %s", session_id)
+                    session_id = None
+                    await message_capture.end()
+            elif session_id is None or not await message_capture.extend(session_id):
+                session_id = await message_capture.begin()
+        except redis.RedisError as e:
+            logger.warning("Failed to update message capture session: %s", e)
+            session_id = None
+        await asyncio.sleep(interval)
 
 
 async def main():
+    await game_info_db.create_table()
+    if setting.METRICS_PORT:
+        await start_metrics_server()
+    # ワーカーでのgame_info更新を受け取って、プロセス内キャッシュを破棄する。
+    asyncio.create_task(game_info_db.cache.listen())
+    asyncio.create_task(flush_metrics_periodically())
     handler = AsyncSocketModeHandler(app=app, app_token=setting.SLACK_APP_TOKEN)
+    asyncio.create_task(keep_message_capture_session(handler.client))
     await handler.start_async()
 
 
 if __name__ == "__main__":
-    import asyncio
     asyncio.run(main())
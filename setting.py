@@ -1,12 +1,17 @@
 import os
 import re
 import json
+import socket
 from dotenv import load_dotenv
 load_dotenv()
 
 
+# docker composeのsecretsがマウントされるディレクトリ。ローカルで動かす場合は変更する。
+SECRETS_DIR = os.environ.get("SECRETS_DIR") or "/run/secrets"
+
+
 def load_secrets(name):
-    with open(f"/run/secrets/{name}") as f:
+    with open(os.path.join(SECRETS_DIR, name)) as f:
         try:
             secrets = json.load(f)
         except json.decoder.JSONDecodeError:
@@ -31,11 +36,44 @@ SLACK_BOT_TOKEN = load_secrets("slack_bot_token")
 SLACK_SIGNING_SECRET = load_secrets("slack_signing_secret")
 SLACK_WORKSPACE_TEAM_ID = os.environ["SLACK_WORKSPACE_TEAM_ID"]
 ERROR_CHANNEL = os.environ["ERROR_CHANNEL"]
+# レート制限(429)のRetry-Afterに従って再送する回数
+SLACK_RATE_LIMIT_MAX_RETRIES = int(os.environ.get("SLACK_RATE_LIMIT_MAX_RETRIES", 5))
+# トークンを待つ最大の秒数。超える場合は送らずにRateLimitWaitTimeoutにする。
+# CELERY_INTERACTIVE_SOFT_TIME_LIMITより長いと、待っている間にSoftTimeLimitExceededでタスクが止まるので、それより短くする。
+SLACK_RATE_LIMIT_MAX_WAIT = float(os.environ.get("SLACK_RATE_LIMIT_MAX_WAIT", 30))
+# falseにするとトークンバケットを使わない(429のRetry-Afterには従う)。
+SLACK_RATE_LIMIT_ENABLED = os.environ.get("SLACK_RATE_LIMIT_ENABLED", "true").lower() == "true"
+# ワーカーの非同期Slackクライアントが使うコネクション数
+SLACK_HTTP_POOL_SIZE = int(os.environ.get("SLACK_HTTP_POOL_SIZE", 20))
+# Slack Web APIのURL。ベンチマークではローカルのフェイクサーバーに向ける。
+SLACK_API_URL = os.environ.get("SLACK_API_URL") or "https://www.slack.com/api/"
+# users.info / users.lookupByEmailの結果をキャッシュする秒数と最大件数
+SLACK_PROFILE_CACHE_TTL = int(os.environ.get("SLACK_PROFILE_CACHE_TTL", 3600))
+SLACK_PROFILE_CACHE_MAXSIZE = int(os.environ.get("SLACK_PROFILE_CACHE_MAXSIZE", 5000))
+# ワークスペース・チャンネルのメンバーとチャンネル一覧をキャッシュする秒数と最大件数
+SLACK_MEMBERSHIP_CACHE_TTL = int(os.environ.get("SLACK_MEMBERSHIP_CACHE_TTL", 60))
+SLACK_MEMBERSHIP_CACHE_MAXSIZE = int(os.environ.get("SLACK_MEMBERSHIP_CACHE_MAXSIZE", 1000))
+# ERROR_CHANNELへのエラーログをまとめて送る間隔(秒)と、送信待ちのログの最大件数(超えた分は捨てる)
+SLACK_LOG_INTERVAL = float(os.environ.get("SLACK_LOG_INTERVAL", 10))
+SLACK_LOG_QUEUE_SIZE = int(os.environ.get("SLACK_LOG_QUEUE_SIZE", 1000))
 
 # Google Spread Sheet
-GCP_SERVICE_ACCOUNT_KEY = "/run/secrets/gcp_service_account_key"
+GCP_SERVICE_ACCOUNT_KEY = os.path.join(SECRETS_DIR, "gcp_service_account_key")
+# アクセストークンの期限がこの秒数以内なら、API呼び出しの前に更新する
+GCP_TOKEN_REFRESH_MARGIN = int(os.environ.get("GCP_TOKEN_REFRESH_MARGIN", 300))
+# Sheets/Drive APIへのkeep-aliveコネクションの数(プロセスごと)
+GSHEET_HTTP_POOL_SIZE = int(os.environ.get("GSHEET_HTTP_POOL_SIZE", 10))
 SPREAD_SHEET_KEY = os.environ["SPREAD_SHEET_KEY"]
 MASTER_SHEET_KEY = os.environ["MASTER_SHEET_KEY"]
+# Masterスプレッドシートのインデックスをキャッシュする秒数(`/reload_master` で即時更新)
+MASTER_SHEET_CACHE_TTL = int(os.environ.get("MASTER_SHEET_CACHE_TTL", 600))
+# Masterスプレッドシートへの書き込みをまとめる間隔(秒)。0以下の場合はすぐに書き込む。
+# 0より大きくする場合は、celery beat(docker-composeのbeatサービス、またはworkerの-B)が必要。
+MASTER_SHEET_FLUSH_INTERVAL = float(os.environ.get("MASTER_SHEET_FLUSH_INTERVAL", 0))
+# SPREAD_SHEET_KEYの共有済みemailをキャッシュする秒数(期限が切れたらDriveから取得し直す)
+DRIVE_PERMISSION_CACHE_TTL = int(os.environ.get("DRIVE_PERMISSION_CACHE_TTL", 86400))
+# caseワークシート(シナリオ)をキャッシュする秒数
+CASE_SHEET_CACHE_TTL = int(os.environ.get("CASE_SHEET_CACHE_TTL", 3600))
 
 # Google Docs
 CUSTOMER_INSTRUCTION = "https://docs.google.com/document/d/1sA4yck9xEcwCx0snUvhq70KlieUF5t7iPC7RySRAnZk/edit?usp=sharing"
@@ -48,9 +86,60 @@ MYSQL_DATABASE = os.environ["MYSQL_DATABASE"]
 MYSQL_USER = os.environ["MYSQL_USER"]
 MYSQL_PASSWORD = os.environ["MYSQL_PASSWORD"]
 MYSQL_HOST = os.environ["MYSQL_HOST"]
+# Bolt側(asyncio)のコネクションプール
+MYSQL_POOL_SIZE = int(os.environ.get("MYSQL_POOL_SIZE", 10))
+MYSQL_MAX_OVERFLOW = int(os.environ.get("MYSQL_MAX_OVERFLOW", 20))
+MYSQL_POOL_TIMEOUT = int(os.environ.get("MYSQL_POOL_TIMEOUT", 10))
+MYSQL_POOL_RECYCLE = int(os.environ.get("MYSQL_POOL_RECYCLE", 1800))
+# 設定した場合はMySQLの代わりにこのURLのDBを使う(ベンチマークでのSQLiteなど)。
+# 例: DATABASE_URL=sqlite:///bench.db, ASYNC_DATABASE_URL=sqlite+aiosqlite:///bench.db
+DATABASE_URL = os.environ.get("DATABASE_URL", "")
+ASYNC_DATABASE_URL = os.environ.get("ASYNC_DATABASE_URL", "")
+
+# Celery
+# 1プロセスが先に受け取っておくタスク数(の倍率)。1にすると、長いタスクの後ろに他のタスクが溜まらない。
+# docker-composeのキューごとのワーカーは、--prefetch-multiplier(CELERY_<キュー>_PREFETCH_MULTIPLIER)の値が優先される。
+CELERY_PREFETCH_MULTIPLIER = int(os.environ.get("CELERY_PREFETCH_MULTIPLIER", 1))
+# タスクの時間制限(秒)。softを超えるとタスク内でSoftTimeLimitExceededが発生し(エラーとしてログに残る)、
+# hardを超えるとワーカーのプロセスごと終了する。
+CELERY_INTERACTIVE_SOFT_TIME_LIMIT = int(os.environ.get("CELERY_INTERACTIVE_SOFT_TIME_LIMIT", 50))
+CELERY_INTERACTIVE_TIME_LIMIT = int(os.environ.get("CELERY_INTERACTIVE_TIME_LIMIT", 60))
+CELERY_EXPORT_SOFT_TIME_LIMIT = int(os.environ.get("CELERY_EXPORT_SOFT_TIME_LIMIT", 270))
+CELERY_EXPORT_TIME_LIMIT = int(os.environ.get("CELERY_EXPORT_TIME_LIMIT", 300))
+CELERY_ADMIN_SOFT_TIME_LIMIT = int(os.environ.get("CELERY_ADMIN_SOFT_TIME_LIMIT", 270))
+CELERY_ADMIN_TIME_LIMIT = int(os.environ.get("CELERY_ADMIN_TIME_LIMIT", 300))
+# `/invite_players all`
+CELERY_BULK_SOFT_TIME_LIMIT = int(os.environ.get("CELERY_BULK_SOFT_TIME_LIMIT", 1740))
+CELERY_BULK_TIME_LIMIT = int(os.environ.get("CELERY_BULK_TIME_LIMIT", 1800))
+
+# Redis
+REDIS_URL = os.environ.get("REDIS_URL") or os.environ.get("CELERY_BROKER_URL") or "redis://localhost:6379"
+GAME_INFO_CACHE_TTL = int(os.environ.get("GAME_INFO_CACHE_TTL", 30))
+GAME_INFO_CACHE_MAXSIZE = int(os.environ.get("GAME_INFO_CACHE_MAXSIZE", 1024))
 
 # Other settings
 LOG_DIR = os.environ["LOG_DIR"]
+# ログファイル名(app.<LOG_SERVICE_NAME>.log)に使う名前。LOG_DIRを複数のコンテナで共有する場合は、サービスごとに変える。
+LOG_SERVICE_NAME = os.environ.get("LOG_SERVICE_NAME") or socket.gethostname()
+# ログファイルの形式("text" または 1行1レコードの"json")と、ローテーションするサイズ・世代数
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "text")
+LOG_FILE_MAX_BYTES = int(os.environ.get("LOG_FILE_MAX_BYTES", 10 * 1024 * 1024))
+LOG_FILE_BACKUP_COUNT = int(os.environ.get("LOG_FILE_BACKUP_COUNT", 5))
+# ハンドラごとのログレベル
+LOG_FILE_LEVEL = os.environ.get("LOG_FILE_LEVEL", "DEBUG").upper()
+LOG_SLACK_LEVEL = os.environ.get("LOG_SLACK_LEVEL", "ERROR").upper()
+# webプロセスが/metrics(Prometheus形式)を返すポート(0で無効)と、ワーカーが集計をログに出す間隔(秒, 0で無効)
+METRICS_PORT = int(os.environ.get("METRICS_PORT", 0))
+METRICS_LOG_INTERVAL = float(os.environ.get("METRICS_LOG_INTERVAL", 300))
+# webプロセスが記録した値(キャッシュのヒット率など)をRedisに送る間隔(秒)。ワーカーはタスクの終了時に送る。
+METRICS_FLUSH_INTERVAL = float(os.environ.get("METRICS_FLUSH_INTERVAL", 15))
+# 対話のエクスポート元。"local"の場合は、ゲーム開始時からwebプロセスがmessageイベントを途切れずに受け取っていれば
+# 記録したメッセージを使い、そうでなければconversations_historyから取得する。"slack"の場合は常にconversations_history。
+DIALOGUE_SOURCE = os.environ.get("DIALOGUE_SOURCE", "slack")
+# webプロセスがmessageイベントの受信状態(MessageCaptureSession)を更新する間隔(秒)
+MESSAGE_CAPTURE_HEARTBEAT_INTERVAL = int(os.environ.get("MESSAGE_CAPTURE_HEARTBEAT_INTERVAL", 10))
+# `/invite_players all` で同時に招待処理を行うチャンネル数
+BULK_INVITE_CONCURRENCY = int(os.environ.get("BULK_INVITE_CONCURRENCY", 4))
 CASE_FILE = os.environ["CASE_FILE"]
 
 
@@ -0,0 +1,40 @@
+import asyncio
+import threading
+from src.app.metrics import current_task
+from src.app.utils import reset_in_forked_child
+
+
+class AsyncRunner:
+    """
+    同期のCeleryタスクからコルーチンを実行するためのイベントループ。
+    プロセスごとにバックグラウンドスレッドで1つのループを動かし続けるので、aiohttpのセッションを使い回せる。
+    """
+
+    def __init__(self):
+        self._reset()
+        reset_in_forked_child(self._reset)
+
+    def _reset(self):
+        # ループのスレッドは子プロセスに引き継がれないので、最初に使うときに作り直す。
+        self.loop = None
+        self.lock = threading.Lock()
+
+    def _ensure_loop(self):
+        with self.lock:
+            if self.loop is None:
+                self.loop = asyncio.new_event_loop()
+                threading.Thread(target=self.loop.run_forever, name="async-runner", daemon=True).start()
+        return self.loop
+
+    def run(self, coro):
+        # ループのスレッドには呼び出し元のcontextvarsが引き継がれないので、計測用のタスク名だけ渡す。
+        async def run_in_task(task_name):
+            current_task.set(task_name)
+            return await coro
+        return asyncio.run_coroutine_threadsafe(run_in_task(current_task.get()), self._ensure_loop()).result()
+
+    def gather(self, *coros):
+        """複数のコルーチンを並行に実行し、全ての結果を返す。どれかが失敗した場合は例外を送出する。"""
+        async def gather():
+            return await asyncio.gather(*coros)
+        return self.run(gather())
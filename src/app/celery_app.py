@@ -0,0 +1,51 @@
+"""
+Celeryアプリの設定だけを持つモジュール。
+webプロセスはタスクの実装(src.app.worker)をimportせず、ここからタスク名でsend_taskする。
+"""
+import os
+import setting
+from celery import Celery
+
+celery = Celery("src.app.worker")
+celery.conf.broker_url = os.environ.get("CELERY_BROKER_URL", "redis://localhost:6379")
+celery.conf.result_backend = os.environ.get("CELERY_RESULT_BACKEND", "redis://localhost:6379")
+# save_messages_taskの実行状況(STARTED)をjob_idから確認できるようにする。
+celery.conf.task_track_started = True
+
+# キュー。ボタンの応答などの軽いタスク(interactive)が、重いエクスポート(export)や
+# 招待・開始などの運営コマンド(admin)の後ろで待たないよう、別々のワーカーで処理する。
+INTERACTIVE_QUEUE = "interactive"
+EXPORT_QUEUE = "export"
+ADMIN_QUEUE = "admin"
+TASK_QUEUES = {
+    "on_open_spreadsheet_task": INTERACTIVE_QUEUE,
+    "on_annotation_done_task": INTERACTIVE_QUEUE,
+    "save_messages_task": EXPORT_QUEUE,
+    "invite_players_task": ADMIN_QUEUE,
+    "invite_players_bulk_task": ADMIN_QUEUE,
+    "start_task": ADMIN_QUEUE,
+    "reload_master_task": ADMIN_QUEUE,
+    "flush_master_sheet_task": ADMIN_QUEUE,
+    "log_metrics_task": ADMIN_QUEUE,
+}
+celery.conf.task_routes = {name: {"queue": queue} for name, queue in TASK_QUEUES.items()}
+celery.conf.task_default_queue = ADMIN_QUEUE
+celery.conf.worker_prefetch_multiplier = setting.CELERY_PREFETCH_MULTIPLIER
+celery.conf.beat_schedule = {}
+if setting.MASTER_SHEET_FLUSH_INTERVAL > 0:
+    celery.conf.beat_schedule["flush-master-sheet"] = {
+        "task": "flush_master_sheet_task",
+        "schedule": setting.MASTER_SHEET_FLUSH_INTERVAL,
+    }
+if setting.METRICS_LOG_INTERVAL > 0:
+    celery.conf.beat_schedule["log-metrics"] = {
+        "task": "log_metrics_task",
+        "schedule": setting.METRICS_LOG_INTERVAL,
+    }
+
+
+def send_task(name, *args):
+    """タスク名でタスクを送る。task_always_eagerの場合は、その場で実行する(タスクの登録が必要)。"""
+    if celery.conf.task_always_eager:
+        return celery.tasks[name].apply(args=args)
+    return celery.send_task(name, args=args)
@@ -1,51 +1,190 @@
+import time
 import setting
+import json
 import logging
-import pandas as pd
-import os
+import redis
 import gspread
-from gspread_dataframe import set_with_dataframe
-from gspread_formatting import DataValidationRule, BooleanCondition, set_data_validation_for_cell_range, batch_updater, cellFormat
-from gspread_formatting.dataframe import format_with_dataframe, BasicFormatter
-from oauth2client.service_account import ServiceAccountCredentials
-from src.db.game_info import GameInfoTable
+from datetime import datetime, timedelta
+from typing import TYPE_CHECKING
+from gspread.utils import rowcol_to_a1
+from google.auth.transport.requests import Request, AuthorizedSession
+from google.oauth2 import service_account
+from requests.adapters import HTTPAdapter
+from src.db.cache import SharedValueCache, get_redis
+from src.app.metrics import metrics, instrument_methods, CACHE_COMPONENT
+from src.app.utils import reset_in_forked_child
+from src.app.sheet_export import build_dialogue_export_requests, build_dialogue_append_requests, new_sheet_id
 
-from src.app.slack import SlackClientWrapper
-slack_client = SlackClientWrapper()
+if TYPE_CHECKING:
+    import pandas as pd
+    from src.db.game_info import GameInfoTable
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
+DRIVE_BATCH_URL = "https://www.googleapis.com/batch/drive/v3"
+# 共有済みemailの集合が空でも「取得済み」と分かるように入れておく値
+PERMISSION_SEEDED_MARKER = "__seeded__"
 
+
+SCOPES = ['https://spreadsheets.google.com/feeds', 'https://www.googleapis.com/auth/drive']
+
+_gsheet_client = None
+
+
+class SpreadsheetShareError(Exception):
+    """一部のemailへの共有に失敗した。開けないリンクをプレイヤーに送らないよう、エクスポートを失敗させる。"""
+
+    def __init__(self, sheet_id, emails):
+        super().__init__(f"Failed to share spreadsheet {sheet_id} with {', '.join(emails)}")
+        self.sheet_id = sheet_id
+        self.emails = emails
+
+
+@reset_in_forked_child
+def _reset_gsheet_client():
+    global _gsheet_client
+    _gsheet_client = None
+
+
+def get_gsheet_client():
+    """プロセスごとに1つのGSheetClientWrapperを、初めて使うときに作って返す。"""
+    global _gsheet_client
+    if _gsheet_client is None:
+        _gsheet_client = GSheetClientWrapper()
+    return _gsheet_client
+
+
+# 外部呼び出しを伴うメソッド。save_dialogueの中のopen_spreadsheetのように、入れ子の呼び出しはそれぞれ記録される。
+@instrument_methods("gsheet", [
+    "open_spreadsheet", "open_worksheet", "add_worksheet", "delete_worksheet",
+    "build_master_index", "save_values_to_master_sheet",
+    "save_dialogue", "append_dialogue", "get_shared_emails", "share_spreadsheet_with", "batch_share_spreadsheet",
+])
 class GSheetClientWrapper:
     def __init__(self):
-        scope = ['https://spreadsheets.google.com/feeds', 'https://www.googleapis.com/auth/drive']
-        creds = ServiceAccountCredentials.from_json_keyfile_name(setting.GCP_SERVICE_ACCOUNT_KEY, scope)
-        self.client = gspread.authorize(creds)
+        # トークンの取得は最初のAPI呼び出し(refresh_token_if_needed)まで行わない。
+        creds = service_account.Credentials.from_service_account_file(setting.GCP_SERVICE_ACCOUNT_KEY, scopes=SCOPES)
+        session = AuthorizedSession(creds)
+        adapter = HTTPAdapter(pool_connections=setting.GSHEET_HTTP_POOL_SIZE, pool_maxsize=setting.GSHEET_HTTP_POOL_SIZE)
+        session.mount("https://", adapter)
+        self.client = gspread.Client(auth=creds, session=session)
+        self.master_index_cache = SharedValueCache("gsheet:master_index", ttl=setting.MASTER_SHEET_CACHE_TTL)
+        self.case_index_cache = SharedValueCache("gsheet:case_index", ttl=setting.CASE_SHEET_CACHE_TTL)
+        # open_by_keyやworksheets()のメタデータ取得を減らすため、ハンドルを使い回す。
+        self.spreadsheets = {}
+        self.worksheets = {}
 
-    def get_master_data(self, body, return_row_index=False):
-        channel_name = body.get("channel_name")
-        worksheet_name = "Sheet1"
-        spreadsheet = self.client.open_by_key(setting.MASTER_SHEET_KEY)
+    def refresh_token_if_needed(self):
+        """アクセストークンの期限が近ければ、API呼び出しが失敗する前に更新しておく。"""
+        creds = self.client.auth
+        expiry = getattr(creds, "expiry", None)
+        margin = timedelta(seconds=setting.GCP_TOKEN_REFRESH_MARGIN)
+        if not creds.valid or (expiry is not None and expiry - datetime.utcnow() < margin):
+            creds.refresh(Request())
+            logger.debug("Refreshed GCP access token. expiry: %s", creds.expiry)
 
-        worksheet = spreadsheet.worksheet(worksheet_name)
-        df = pd.DataFrame(worksheet.get_all_records())
+    def open_spreadsheet(self, key) -> gspread.Spreadsheet:
+        self.refresh_token_if_needed()
+        if key not in self.spreadsheets:
+            self.spreadsheets[key] = self.client.open_by_key(key)
+        return self.spreadsheets[key]
 
-        assert len(df) != 0, "Masterスプレッドシートの取得に失敗しました。"
+    def open_worksheet(self, key, title) -> gspread.Worksheet or None:
+        """(key, title)のworksheetを返す。存在しない場合はNone。"""
+        if (key, title) not in self.worksheets:
+            # 1回のworksheets()で、そのスプレッドシートの全てのworksheetをキャッシュする。
+            for worksheet in self.open_spreadsheet(key).worksheets():
+                self.worksheets[(key, worksheet.title)] = worksheet
+        else:
+            self.refresh_token_if_needed()
+        return self.worksheets.get((key, title))
 
-        matching_row = df[df['channel_name'] == channel_name]
+    def add_worksheet(self, key, title, rows, cols) -> gspread.Worksheet:
+        worksheet = self.open_spreadsheet(key).add_worksheet(title=title, rows=rows, cols=cols)
+        self.worksheets[(key, title)] = worksheet
+        return worksheet
 
-        logging.debug(f"Matching row: {matching_row}")
+    def delete_worksheet(self, key, title):
+        worksheet = self.open_worksheet(key, title)
+        if worksheet is not None:
+            self.open_spreadsheet(key).del_worksheet(worksheet)
+        self.invalidate_handles(key)
+
+    def invalidate_handles(self, key=None):
+        """worksheetが追加・削除された場合(シート上での手動操作を含む)に、キャッシュしたハンドルを捨てる。"""
+        if key is None:
+            self.spreadsheets.clear()
+            self.worksheets.clear()
+            return
+        self.spreadsheets.pop(key, None)
+        for cached_key, title in list(self.worksheets):
+            if cached_key == key:
+                self.worksheets.pop((cached_key, title))
+
+    def get_master_data(self, body, return_row_index=False):
+        channel_name = body.get("channel_name")
+        master_index = self.get_master_index()
 
-        assert len(matching_row) != 0, f"スプレッドシートにチャンネル名{channel_name}が存在しません。"
-        assert len(matching_row) == 1, f"スプレッドシートにチャンネル名{channel_name}が重複して存在しています。"
+        assert channel_name not in master_index["duplicates"], f"スプレッドシートにチャンネル名{channel_name}が重複して存在しています。"
+        assert channel_name in master_index["rows"], f"スプレッドシートにチャンネル名{channel_name}が存在しません。"
 
-        # Update invited column
-        target_row_index = matching_row.index[0]+ 2
+        master_data, target_row_index = master_index["rows"][channel_name]
+        logger.debug("Matching row: %s", master_data)
 
         if return_row_index:
-            return matching_row.to_dict(orient='records')[0], target_row_index
+            return master_data, target_row_index
         else:
-            return matching_row.to_dict(orient='records')[0]
+            return master_data
+
+    def get_master_index(self, refresh=False):
+        """
+        Masterスプレッドシートのインデックスを返す。Redisにキャッシュされていれば、Sheets APIは呼ばない。
+
+        Returns:
+            dict: {
+                'rows': {channel_name: [行のdict, 行番号]},
+                'duplicates': [重複しているchannel_name],
+                'missing_rows': [channel_nameが空の行番号]
+            }
+        """
+        if not refresh:
+            master_index = self.master_index_cache.get()
+            metrics.count(CACHE_COMPONENT, "master_index:hit" if master_index is not None else "master_index:miss")
+            if master_index is not None:
+                return master_index
+        master_index = self.build_master_index()
+        self.master_index_cache.set(master_index)
+        return master_index
+
+    def build_master_index(self):
+        rows = {}
+        duplicates = set()
+        missing_rows = []
+        for record, row_index in self.get_master_rows():
+            channel_name = record.get("channel_name")
+            if not channel_name:
+                missing_rows.append(row_index)
+            elif channel_name in rows:
+                duplicates.add(channel_name)
+            else:
+                rows[channel_name] = [record, row_index]
+
+        for channel_name in duplicates:
+            rows.pop(channel_name)
+        if duplicates:
+            logger.warning("Duplicate channel names in master sheet: %s", sorted(duplicates))
+        if missing_rows:
+            logger.warning("Rows without channel name in master sheet: %s", missing_rows)
+        return dict(rows=rows, duplicates=sorted(duplicates), missing_rows=missing_rows)
+
+    def get_master_rows(self):
+        """Masterスプレッドシートの全行を1回の読み込みで取得し、(行のdict, 行番号)のリストで返す。"""
+        worksheet = self.open_worksheet(setting.MASTER_SHEET_KEY, "Sheet1")
+        records = worksheet.get_all_records()
+        assert len(records) != 0, "Masterスプレッドシートの取得に失敗しました。"
+        # 1行目はヘッダーなので、データの行番号は2から始まる。
+        return [(record, row_index) for row_index, record in enumerate(records, start=2)]
 
     def get_case_data(self, case_id) -> dict or None:
         """
@@ -66,86 +205,298 @@ class GSheetClientWrapper:
                     'honest_scenario': str
                 }
         """
-        sheet = self.client.open_by_key(setting.MASTER_SHEET_KEY).worksheet("case")
-        logger.debug(f"sheet: {sheet}")
-        records = sheet.get_all_records()
-        for record in records:
-            if record['case_id'] == case_id:
-                return record
-        raise ValueError(f"Case ID {case_id} not found in spreadsheet.")
+        case_index = self.get_case_index()
+        record = case_index.get(str(case_id))
+        if record is None:
+            # キャッシュ作成後に追加されたケースかもしれないので、一度だけ読み込み直す。
+            record = self.get_case_index(refresh=True).get(str(case_id))
+        if record is None:
+            raise ValueError(f"Case ID {case_id} not found in spreadsheet.")
+        return record
+
+    def get_case_index(self, refresh=False):
+        """caseワークシートを case_id(str) -> レコード の辞書にしたものを返す。Redisにキャッシュする。"""
+        if not refresh:
+            case_index = self.case_index_cache.get()
+            metrics.count(CACHE_COMPONENT, "case_index:hit" if case_index is not None else "case_index:miss")
+            if case_index is not None:
+                return case_index
+        # キャッシュのヒットをSheetsの呼び出しとして数えないよう、読み込みの部分だけを計測する。
+        with metrics.timed("gsheet", "get_case_index"):
+            sheet = self.open_worksheet(setting.MASTER_SHEET_KEY, "case")
+            logger.debug("sheet: %s", sheet)
+            records = sheet.get_all_records()
+        case_index = {str(record['case_id']): record for record in records}
+        self.case_index_cache.set(case_index)
+        return case_index
+
+    def invalidate_case_index(self):
+        self.case_index_cache.invalidate()
 
     def save_value_to_master_sheet(self, target_row_index, target_col_index, value):
-        spreadsheet = self.client.open_by_key(os.environ['MASTER_SHEET_KEY'])
-        worksheet = spreadsheet.worksheet("Sheet1")
-        worksheet.update_cell(target_row_index, target_col_index, value)
+        self.save_values_to_master_sheet([(target_row_index, target_col_index, value)])
+
+    def save_values_to_master_sheet(self, updates):
+        """(行番号, 列番号, 値)のリストを、1回のbatch_updateでMasterスプレッドシートに書き込む。"""
+        if not updates:
+            return
+        worksheet = self.open_worksheet(setting.MASTER_SHEET_KEY, "Sheet1")
+        data = [{"range": rowcol_to_a1(row, col), "values": [[value]]} for row, col, value in updates]
+        worksheet.batch_update(data, value_input_option="USER_ENTERED")
 
-    def save_dialogue(self, game_info: GameInfoTable, df: pd.DataFrame):
-        logger.debug(f"game_info: {game_info}")
-        sheet = self.client.open_by_key(setting.SPREAD_SHEET_KEY)
+    def save_dialogue(self, game_info: "GameInfoTable", df: "pd.DataFrame", dry_run=False):
+        try:
+            return self._save_dialogue(game_info, df, dry_run=dry_run)
+        except gspread.exceptions.APIError as e:
+            # キャッシュしていたworksheetが手動で削除された場合などは、ハンドルを捨てて一度だけやり直す。
+            logger.warning("Retrying save_dialogue with fresh handles: %s", e)
+            self.invalidate_handles(setting.SPREAD_SHEET_KEY)
+            return self._save_dialogue(game_info, df, dry_run=dry_run)
+
+    def _save_dialogue(self, game_info: "GameInfoTable", df: "pd.DataFrame", dry_run=False):
+        """
+        対話をworksheetに書き出す。値・書式・入力規則・保護範囲は1回のbatchUpdateでまとめて送る。
+        dry_run=Trueの場合は共有もbatchUpdateも行わず、送る予定のpayloadを返す。
+        """
+        logger.debug("game_info: %s", game_info)
+        sheet = self.open_spreadsheet(setting.SPREAD_SHEET_KEY)
 
-        for email in setting.STAFF_BOT_EMALS + [game_info.customer_email, game_info.sales_email]:
-            self.share_spreadsheet(sheet, email)
+        if not dry_run:
+            self.share_spreadsheet_with(sheet, setting.STAFF_BOT_EMALS + [game_info.customer_email, game_info.sales_email])
 
         # 既に同じ名前のworksheetが存在すれば、それを上書きする。
-        worksheet_list = sheet.worksheets()
-        worksheet = None
-        for ws in worksheet_list:
-            if ws.title == game_info.channel_name:
-                worksheet = ws
+        metadata = sheet.fetch_sheet_metadata(params={"fields": "sheets(properties(sheetId,title),protectedRanges(protectedRangeId))"})
+        existing = None
+        for sheet_metadata in metadata.get("sheets", []):
+            if sheet_metadata["properties"]["title"] == game_info.channel_name:
+                existing = sheet_metadata
                 break
-        if worksheet is None:
-            worksheet = sheet.add_worksheet(title=game_info.channel_name, rows=10, cols=4)
-        worksheet.clear()
-        set_with_dataframe(worksheet, df)
-
-        # ヘッダーのフォーマッティング
-        header_formatter = BasicFormatter(
-            freeze_headers=True,
-        )
-        format_with_dataframe(worksheet, df, header_formatter)
 
-        with batch_updater(worksheet.spreadsheet) as batch:
-            message_column_formatting = cellFormat(
-                horizontalAlignment="LEFT",
-                wrapStrategy="WRAP"
-            )
-            batch.set_column_width(worksheet, 'D:D', 700)
-            batch.set_column_width(worksheet, 'G:G', 500)
-            batch.format_cell_range(worksheet, 'D:D', message_column_formatting)
-            batch.format_cell_range(worksheet, 'G:G', message_column_formatting)
-
-        lie_col_range = f'E2:E{len(df.index) + 1}'
-        suspicious_col_range = f'F2:F{len(df.index) + 1}'
-        reason_col_range = f'G2:G{len(df.index) + 1}'
-
-        # lieカラムのTrue, Falseをチェックボックに
-        validation_rule = DataValidationRule(
-            BooleanCondition('BOOLEAN', ['TRUE', 'FALSE']),
-            showCustomUi=True
-        )
-        set_data_validation_for_cell_range(worksheet, lie_col_range, validation_rule)
-        set_data_validation_for_cell_range(worksheet, suspicious_col_range, validation_rule)
-
-        # 編集制限
-        # lie/suspiciousカラムに編集制限をかける
-        if game_info.is_liar:  # 詐欺師の場合のみ嘘の発話をアノテーション出来る
-            logger.debug(f"is_liar: {game_info.is_liar}")
-            worksheet.add_protected_range(name=lie_col_range, editor_users_emails=setting.STAFF_BOT_ID_GMAILS + [game_info.sales_email])
-            worksheet.add_protected_range(name=reason_col_range, editor_users_emails=setting.STAFF_BOT_ID_GMAILS + [game_info.customer_email, game_info.sales_email])
-            worksheet.add_protected_range(name=suspicious_col_range, editor_users_emails=setting.STAFF_BOT_ID_GMAILS + [game_info.customer_email])
+        if existing is None:
+            sheet_id = new_sheet_id(game_info.channel_name, [s["properties"]["sheetId"] for s in metadata.get("sheets", [])])
+            protected_range_ids = []
         else:
-            logger.debug(f"is_liar: {game_info.is_liar}")
-            worksheet.add_protected_range(name=suspicious_col_range, editor_users_emails=setting.STAFF_BOT_ID_GMAILS + [game_info.customer_email])
-            worksheet.add_protected_range(name=reason_col_range, editor_users_emails=setting.STAFF_BOT_ID_GMAILS + [game_info.customer_email])
+            sheet_id = existing["properties"]["sheetId"]
+            protected_range_ids = [r["protectedRangeId"] for r in existing.get("protectedRanges", [])]
 
-        other_cols_range = f"A1:D{len(df.index) + 1}"
-        header_range = "A1:F1"
+        payload = {"requests": build_dialogue_export_requests(game_info, df, sheet_id, new_sheet=existing is None, protected_range_ids=protected_range_ids)}
+        if dry_run:
+            return payload
 
-        worksheet.add_protected_range(name=other_cols_range, editor_users_emails=setting.STAFF_BOT_ID_GMAILS)
-        worksheet.add_protected_range(name=header_range, editor_users_emails=setting.STAFF_BOT_ID_GMAILS)
+        response = sheet.batch_update(payload)
+        if existing is None:
+            properties = response["replies"][len(protected_range_ids)]["addSheet"]["properties"]
+            self.worksheets[(setting.SPREAD_SHEET_KEY, game_info.channel_name)] = gspread.Worksheet(sheet, properties)
 
-        return worksheet.url
+        return f"{sheet.url}#gid={sheet_id}"
+
+    def append_dialogue(self, game_info: "GameInfoTable", df: "pd.DataFrame", sheet_id: int):
+        """前回エクスポートしたworksheet(sheet_id)の末尾に、新しいメッセージだけを追記する。アノテーションはそのまま残る。"""
+        sheet = self.open_spreadsheet(setting.SPREAD_SHEET_KEY)
+        self.share_spreadsheet_with(sheet, setting.STAFF_BOT_EMALS + [game_info.customer_email, game_info.sales_email])
+        requests = build_dialogue_append_requests(df, sheet_id)
+        if requests:
+            sheet.batch_update({"requests": requests})
+        return f"{sheet.url}#gid={sheet_id}"
 
     def share_spreadsheet(self, sheet: gspread.Spreadsheet, email: str):
         sheet.share(email, perm_type='user', role='writer', with_link=False, notify=False)
-        logging.info(f"Shared spreadsheet with {email}")
+        logger.info("Shared spreadsheet with %s", email)
+
+    def share_spreadsheet_with(self, sheet: gspread.Spreadsheet, emails: list):
+        """
+        まだ共有していないemailにだけ共有する。複数ある場合は1回のDriveのバッチリクエストで共有する。
+        共有に失敗したemailがあればSpreadsheetShareErrorを送出する。
+        """
+        shared_emails = self.get_shared_emails(sheet)
+        new_emails = [email for email in dict.fromkeys(email.lower() for email in emails) if email not in shared_emails]
+        if not new_emails:
+            return
+
+        if len(new_emails) == 1:
+            self.share_spreadsheet(sheet, new_emails[0])
+            succeeded = new_emails
+        else:
+            succeeded = self.batch_share_spreadsheet(sheet, new_emails)
+        if succeeded:
+            try:
+                self._add_shared_emails(get_redis(), sheet, succeeded)
+            except redis.RedisError as e:
+                # 次回また共有を試みるだけなので、エクスポートは続ける。
+                logger.warning("Failed to cache shared emails for %s: %s", sheet.id, e)
+
+        failed = [email for email in new_emails if email not in succeeded]
+        if failed:
+            raise SpreadsheetShareError(sheet.id, failed)
+
+    def _permission_key(self, sheet: gspread.Spreadsheet):
+        return f"gsheet:permissions:{sheet.id}"
+
+    def _add_shared_emails(self, client, sheet: gspread.Spreadsheet, emails: list):
+        """
+        共有済みの集合にemailsを加える。キーが期限切れで消えていた場合は何もしない。
+        (SEEDED_MARKERのない一部だけの集合を作ると、Driveから取り直されなくなるため)
+        """
+        key = self._permission_key(sheet)
+        with client.pipeline() as pipe:
+            try:
+                pipe.watch(key)
+                if not pipe.exists(key):
+                    return
+                pipe.multi()
+                pipe.sadd(key, *emails)
+                pipe.expire(key, setting.DRIVE_PERMISSION_CACHE_TTL)
+                pipe.execute()
+            except redis.WatchError:
+                # 他のプロセスが同時に更新した(または期限切れになった)。次回の共有で取り直す。
+                pass
+
+    def _list_shared_emails(self, sheet: gspread.Spreadsheet) -> set:
+        emails = set()
+        for permission in sheet.list_permissions():
+            if permission.get("emailAddress"):
+                emails.add(permission["emailAddress"].lower())
+        return emails
+
+    def get_shared_emails(self, sheet: gspread.Spreadsheet) -> set:
+        """
+        共有済みのemailの集合。初回(またはTTL切れ)のみDriveのpermissions一覧から作り、Redisに保存する。
+        Redisが使えない場合は、毎回Driveのpermissions一覧を使う。
+        """
+        key = self._permission_key(sheet)
+        try:
+            client = get_redis()
+            emails = client.smembers(key)
+        except redis.RedisError as e:
+            logger.warning("Failed to read shared emails for %s from redis: %s", sheet.id, e)
+            return self._list_shared_emails(sheet)
+        if emails:
+            return emails
+
+        emails = {PERMISSION_SEEDED_MARKER} | self._list_shared_emails(sheet)
+        try:
+            pipe = client.pipeline()
+            pipe.sadd(key, *emails)
+            pipe.expire(key, setting.DRIVE_PERMISSION_CACHE_TTL)
+            pipe.execute()
+        except redis.RedisError as e:
+            logger.warning("Failed to cache shared emails for %s: %s", sheet.id, e)
+        return emails
+
+    def batch_share_spreadsheet(self, sheet: gspread.Spreadsheet, emails: list) -> list:
+        """Drive APIのバッチリクエストで複数のemailに共有し、共有に成功したemailを返す。"""
+        boundary = "batch_share_spreadsheet"
+        parts = []
+        for i, email in enumerate(emails):
+            parts.append(
+                f"--{boundary}\r\n"
+                "Content-Type: application/http\r\n"
+                f"Content-ID: <{i}>\r\n\r\n"
+                f"POST /drive/v3/files/{sheet.id}/permissions?sendNotificationEmail=false&supportsAllDrives=true\r\n"
+                "Content-Type: application/json\r\n\r\n"
+                f"{json.dumps({'type': 'user', 'role': 'writer', 'emailAddress': email})}\r\n"
+            )
+        body = "".join(parts) + f"--{boundary}--"
+        self.refresh_token_if_needed()
+        response = self.client.session.post(
+            DRIVE_BATCH_URL,
+            data=body.encode(),
+            headers={"Content-Type": f"multipart/mixed; boundary={boundary}"},
+        )
+        response.raise_for_status()
+
+        succeeded = []
+        for part in response.text.split("Content-ID:")[1:]:
+            content_id, _, rest = part.partition("\n")
+            index = int(content_id.strip().strip("<>").split("-")[-1])
+            status_line = next((line for line in rest.splitlines() if line.startswith("HTTP/")), "")
+            if " 200 " in status_line or status_line.endswith(" 200"):
+                succeeded.append(emails[index])
+                logger.info("Shared spreadsheet with %s", emails[index])
+            else:
+                logger.warning("Failed to share spreadsheet with %s: %s", emails[index], status_line)
+        return succeeded
+
+
+class MasterSheetWriteQueue:
+    """
+    Masterスプレッドシートへの書き込みをRedisに溜めておき、flush()でまとめて書き込む(write-behind)。
+    同じセルへの書き込みは最後の値だけが残る。失敗した場合にどのゲームの書き込みか分かるよう、セルごとにchannel_idも残す。
+    """
+    key = "gsheet:master_sheet_writes"
+    channels_key = "gsheet:master_sheet_writes:channels"
+    flushed_at_key = "gsheet:master_sheet_writes:flushed_at"
+
+    def __init__(self, interval=setting.MASTER_SHEET_FLUSH_INTERVAL):
+        # これより長くflushされていなければ、celery beatが動いていないとみなして警告する。
+        self.stale_after = max(60, 10 * interval)
+
+    def enqueue(self, updates, channel_id=None):
+        if not updates:
+            return
+        cells = [f"{row}:{col}" for row, col, _ in updates]
+        pipe = get_redis().pipeline(transaction=True)
+        pipe.hset(self.key, mapping={cell: json.dumps(value) for cell, (_, _, value) in zip(cells, updates)})
+        pipe.hset(self.channels_key, mapping={cell: channel_id or "" for cell in cells})
+        pipe.get(self.flushed_at_key)
+        flushed_at = pipe.execute()[-1]
+        if flushed_at is None or time.time() - float(flushed_at) > self.stale_after:
+            logger.warning(
+                "Queued master sheet writes for <#%s>, but flush_master_sheet_task has not run for %ss. Is celery beat running?",
+                channel_id, self.stale_after,
+            )
+
+    def drain(self):
+        pipe = get_redis().pipeline(transaction=True)
+        pipe.hgetall(self.key)
+        pipe.hgetall(self.channels_key)
+        pipe.delete(self.key, self.channels_key)
+        pending, channels, _ = pipe.execute()
+        updates = []
+        for cell, value in pending.items():
+            row, col = cell.split(":")
+            updates.append((int(row), int(col), json.loads(value), channels.get(cell) or None))
+        return sorted(updates, key=lambda update: update[:2])
+
+    def requeue(self, updates):
+        # flushに失敗した分を戻す。その間に書き込まれた新しい値は上書きしない。
+        pipe = get_redis().pipeline()
+        for row, col, value, channel_id in updates:
+            pipe.hsetnx(self.key, f"{row}:{col}", json.dumps(value))
+            pipe.hsetnx(self.channels_key, f"{row}:{col}", channel_id or "")
+        pipe.execute()
+
+    def flush(self, gsheet_client: GSheetClientWrapper):
+        updates = self.drain()
+        get_redis().set(self.flushed_at_key, time.time())
+        if not updates:
+            return 0
+        try:
+            gsheet_client.save_values_to_master_sheet([update[:3] for update in updates])
+        except Exception:
+            self.requeue(updates)
+            channel_ids = sorted({channel_id for *_, channel_id in updates if channel_id})
+            logger.warning("Failed to flush master sheet; re-queued %s cells for channels: %s", len(updates), channel_ids)
+            raise
+        logger.info("Flushed %s cells to master sheet", len(updates))
+        return len(updates)
+
+
+class DialogueExportState:
+    """チャンネルごとに、最後にエクスポートしたメッセージのtsと書き出し先のsheetIdを保存する。"""
+    key_prefix = "dialogue_export:"
+
+    def _key(self, channel_id):
+        return f"{self.key_prefix}{channel_id}"
+
+    def get(self, channel_id):
+        state = get_redis().hgetall(self._key(channel_id))
+        if not state:
+            return None
+        return dict(last_ts=state.get("last_ts") or None, sheet_id=int(state["sheet_id"]))
+
+    def set(self, channel_id, last_ts, sheet_id):
+        get_redis().hset(self._key(channel_id), mapping=dict(last_ts=last_ts or "", sheet_id=sheet_id))
+
+    def clear(self, channel_id):
+        get_redis().delete(self._key(channel_id))
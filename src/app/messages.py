@@ -1,14 +1,14 @@
 import json
 import logging
 import setting
-from src.app.gsheet import GSheetClientWrapper
-from src.db.game_info import GameInfoTable
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from src.db.game_info import GameInfoTable
 
 logger = logging.getLogger("slack_game_master")
 logger.setLevel(logging.DEBUG)
 
-gsheet_client = GSheetClientWrapper()
-
 GENERAL_CHANNEL_ID = "C04LWLAE5SM"
 INCENTIVE = "ハーゲンダッツ"
 
@@ -46,8 +46,9 @@ def start_message_block(customer_id, sales_id):
 
 
 def role_instruction_block(channel_id, case_id, role, is_liar):
-    
-    case_record = gsheet_client.get_case_data(case_id=case_id)
+    # gspread・google-authの読み込みはwebプロセスでは不要なので、使うときまで遅らせる。
+    from src.app.gsheet import get_gsheet_client
+    case_record = get_gsheet_client().get_case_data(case_id=case_id)
     role_instruction_message = (
         f"<#{channel_id}>\n"
     )
@@ -97,11 +98,19 @@ def role_instruction_block(channel_id, case_id, role, is_liar):
     return role_instruction_block
 
 
+def export_queued_message(user_id, job_id):
+    return f"<@{user_id}> スプレッドシートへの書き出しを開始しました。(job_id: `{job_id}`)"
+
+
+def export_running_message(user_id, job_id):
+    return f"<@{user_id}> スプレッドシートへの書き出しを実行中です。完了までしばらくお待ち下さい。(job_id: `{job_id}`)"
+
+
 def judge_receipt_message(user_id):
     return f"<@{user_id}> 判定を受け付けました。ありがとうございます。\nスプレッドシートを作成し、リンクを送りますのでしばらくお待ち下さい。"
 
 
-def ask_annotation_block(worksheet_url: str, game_info: GameInfoTable):
+def ask_annotation_block(worksheet_url: str, game_info: "GameInfoTable"):
     return [
         {
             "type": "section",
@@ -214,6 +223,24 @@ def thank_you_for_annotation_message(user_id):
     return f"<@{user_id}>アノテーション完了です。お疲れさまでした。"
 
 
+def bulk_invite_summary_message(user_id, invited_channel_ids, failures):
+    message = f"<@{user_id}> `/invite_players` の一括招待が完了しました。\n成功: {len(invited_channel_ids)}件, 失敗: {len(failures)}件\n"
+    if invited_channel_ids:
+        message += "*招待したチャンネル*\n" + " ".join(f"<#{channel_id}>" for channel_id in invited_channel_ids) + "\n"
+    if failures:
+        message += "*失敗したチャンネル*\n" + "\n".join(f"• {channel_name}: {error}" for channel_name, error in failures.items())
+    return message
+
+
+def master_reload_report_message(user_id, master_index):
+    message = f"<@{user_id}> Masterスプレッドシート(Sheet1, case)を再読み込みしました。(チャンネル数: {len(master_index['rows'])})\n"
+    if master_index["duplicates"]:
+        message += f"*重複しているチャンネル名*: {', '.join(master_index['duplicates'])}\n"
+    if master_index["missing_rows"]:
+        message += f"*チャンネル名が空の行*: {', '.join(map(str, master_index['missing_rows']))}\n"
+    return message
+
+
 def command_confirmation_message(body):
     return f"<@{body['user_id']}> `{body['command']}` を受け付けました。しばらくお待ち下さい。"
 
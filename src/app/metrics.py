@@ -0,0 +1,186 @@
+"""
+タスクごと・外部呼び出し(Slack, Google Sheets, MySQL)ごとの回数、エラー数、所要時間を記録する。
+
+記録はプロセス内で貯めておき、タスクの終了時にRedisのハッシュにまとめて加算する。
+集計結果はPrometheusのテキスト形式(render_prometheus)か、ログ用のサマリー(format_summary)で確認できる。
+"""
+import time
+import logging
+import threading
+import functools
+import contextvars
+from contextlib import contextmanager
+import redis
+from src.db.cache import get_redis
+
+logger = logging.getLogger(__name__)
+
+METRICS_KEY = "metrics:calls"
+# ヒストグラムの区切り(秒)
+BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, float("inf"))
+# タスク自体の所要時間はcomponent="task", method=結果(success / failure)として記録する。
+TASK_COMPONENT = "task"
+# キャッシュの参照はcomponent="cache", method="<キャッシュ名>:<hit | miss>"として回数だけを記録する。
+CACHE_COMPONENT = "cache"
+NO_TASK = "-"
+
+# 実行中のCeleryタスク名。外部呼び出しの記録をタスクごとに分けるのに使う。
+current_task = contextvars.ContextVar("current_task", default=NO_TASK)
+
+
+class Metrics:
+    def __init__(self):
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    def observe(self, component, method, seconds, error=False):
+        bucket = next(i for i, le in enumerate(BUCKETS) if seconds <= le)
+        prefix = (current_task.get(), component, method)
+        with self.lock:
+            for stat, value in (("count", 1), ("sum", seconds), (f"bucket:{bucket}", 1), ("errors", int(error))):
+                key = prefix + (stat,)
+                self.pending[key] = self.pending.get(key, 0) + value
+
+    def count(self, component, method, value=1):
+        """所要時間のない回数だけを記録する(キャッシュのヒット・ミスなど)。"""
+        key = (current_task.get(), component, method, "count")
+        with self.lock:
+            self.pending[key] = self.pending.get(key, 0) + value
+
+    @contextmanager
+    def timed(self, component, method):
+        start = time.perf_counter()
+        error = False
+        try:
+            yield
+        except BaseException:
+            error = True
+            raise
+        finally:
+            self.observe(component, method, time.perf_counter() - start, error)
+
+    def flush(self):
+        """貯めた値をRedisに加算する。Redisが使えない場合は捨てる(計測のためにタスクを失敗させない)。"""
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        if not pending:
+            return
+        try:
+            pipe = get_redis().pipeline(transaction=False)
+            for key, value in pending.items():
+                if value:
+                    pipe.hincrbyfloat(METRICS_KEY, "\t".join(key), value)
+            pipe.execute()
+        except redis.RedisError as e:
+            logger.warning("Failed to flush metrics: %s", e)
+
+    def load(self):
+        """Redisから全プロセスの集計を読み込む。{(task, component, method): {stat: value}}"""
+        rows = {}
+        for field, value in get_redis().hgetall(METRICS_KEY).items():
+            task, component, method, stat = field.split("\t")
+            rows.setdefault((task, component, method), {})[stat] = float(value)
+        return rows
+
+
+metrics = Metrics()
+
+
+def instrument_methods(component, method_names):
+    """クラスデコレータ。指定したメソッドの呼び出し回数・所要時間・エラーをcomponentとして記録する。"""
+    def decorate(cls):
+        for name in method_names:
+            method = getattr(cls, name)
+
+            def wrap(method, name):
+                @functools.wraps(method)
+                def wrapper(*args, **kwargs):
+                    with metrics.timed(component, name):
+                        return method(*args, **kwargs)
+                return wrapper
+            setattr(cls, name, wrap(method, name))
+        return cls
+    return decorate
+
+
+@contextmanager
+def task_context(task_name):
+    """タスクの実行中はcurrent_taskを設定し、終了時にタスクの所要時間と結果を記録してRedisに送る。"""
+    token = current_task.set(task_name)
+    start = time.perf_counter()
+    outcome = "failure"
+    try:
+        yield
+        outcome = "success"
+    finally:
+        metrics.observe(TASK_COMPONENT, outcome, time.perf_counter() - start, error=outcome == "failure")
+        current_task.reset(token)
+        metrics.flush()
+
+
+def _labels(**labels):
+    return ",".join(f'{name}="{value}"' for name, value in labels.items())
+
+
+def render_prometheus(rows=None):
+    """集計をPrometheusのテキスト形式にする。"""
+    rows = metrics.load() if rows is None else rows
+    lines = []
+    for metric_name, is_task, help_text in (
+        ("game_master_task_duration_seconds", True, "Celery task duration by outcome"),
+        ("game_master_external_call_duration_seconds", False, "Slack, Google Sheets and MySQL call duration"),
+    ):
+        lines.append(f"# HELP {metric_name} {help_text}")
+        lines.append(f"# TYPE {metric_name} histogram")
+        for (task, component, method), stats in sorted(rows.items()):
+            if component == CACHE_COMPONENT or (component == TASK_COMPONENT) != is_task:
+                continue
+            labels = dict(task=task, outcome=method) if is_task else dict(task=task, component=component, method=method)
+            cumulative = 0
+            for i, le in enumerate(BUCKETS):
+                cumulative += stats.get(f"bucket:{i}", 0)
+                le_label = "+Inf" if le == float("inf") else le
+                lines.append(f"{metric_name}_bucket{{{_labels(**labels, le=le_label)}}} {cumulative:g}")
+            lines.append(f"{metric_name}_sum{{{_labels(**labels)}}} {stats.get('sum', 0):g}")
+            lines.append(f"{metric_name}_count{{{_labels(**labels)}}} {stats.get('count', 0):g}")
+
+    error_name = "game_master_external_call_errors_total"
+    lines.append(f"# HELP {error_name} Failed Slack, Google Sheets and MySQL calls")
+    lines.append(f"# TYPE {error_name} counter")
+    for (task, component, method), stats in sorted(rows.items()):
+        if component not in (TASK_COMPONENT, CACHE_COMPONENT):
+            lines.append(f"{error_name}{{{_labels(task=task, component=component, method=method)}}} {stats.get('errors', 0):g}")
+
+    cache_name = "game_master_cache_lookups_total"
+    lines.append(f"# HELP {cache_name} Cache lookups by result")
+    lines.append(f"# TYPE {cache_name} counter")
+    for (task, component, method), stats in sorted(rows.items()):
+        if component == CACHE_COMPONENT:
+            cache, result = method.rsplit(":", 1)
+            lines.append(f"{cache_name}{{{_labels(task=task, cache=cache, result=result)}}} {stats.get('count', 0):g}")
+    return "\n".join(lines) + "\n"
+
+
+def format_summary(top=30):
+    """所要時間の合計が大きい順に、タスク・外部呼び出しごとの回数、エラー率、平均時間を表にする。"""
+    rows = metrics.load()
+    calls = {key: stats for key, stats in rows.items() if key[1] != CACHE_COMPONENT}
+    ranked = sorted(calls.items(), key=lambda item: item[1].get("sum", 0), reverse=True)[:top]
+    lines = [f"{'task':<28} {'component':<10} {'method':<32} {'count':>7} {'error%':>7} {'avg(s)':>8} {'total(s)':>9}"]
+    for (task, component, method), stats in ranked:
+        count = stats.get("count", 0) or 1
+        lines.append(
+            f"{task:<28} {component:<10} {method:<32} {stats.get('count', 0):>7.0f} "
+            f"{100 * stats.get('errors', 0) / count:>6.1f}% {stats.get('sum', 0) / count:>8.3f} {stats.get('sum', 0):>9.1f}"
+        )
+
+    lookups = {}
+    for (task, component, method), stats in rows.items():
+        if component == CACHE_COMPONENT:
+            cache, result = method.rsplit(":", 1)
+            counts = lookups.setdefault(cache, {})
+            counts[result] = counts.get(result, 0) + stats.get("count", 0)
+    for cache, counts in sorted(lookups.items()):
+        total = sum(counts.values()) or 1
+        lines.append(f"cache {cache}: {counts.get('hit', 0):.0f} hits / {counts.get('miss', 0):.0f} misses ({100 * counts.get('hit', 0) / total:.1f}% hit)")
+    return "\n".join(lines)
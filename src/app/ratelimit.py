@@ -0,0 +1,189 @@
+"""
+Slack Web APIのメソッドごとのレート制限(Tier)に合わせて、リクエストの送信を待たせる。
+トークンバケットはRedisに置くので、全てのCeleryワーカーとwebプロセスで共有される。
+"""
+import time
+import asyncio
+import logging
+import redis
+from slack_sdk.http_retry.builtin_handlers import RateLimitErrorRetryHandler
+from slack_sdk.http_retry.builtin_async_handlers import AsyncRateLimitErrorRetryHandler
+from src.db.cache import get_redis
+import setting
+
+logger = logging.getLogger(__name__)
+
+# 1分あたりのリクエスト数 https://api.slack.com/docs/rate-limits
+TIER_1 = 1
+TIER_2 = 20
+TIER_3 = 50
+TIER_4 = 100
+# chat.postMessageはチャンネルごとに1秒1件程度
+POST_MESSAGE_PER_CHANNEL = 60
+
+METHOD_TIERS = {
+    "chat.postMessage": POST_MESSAGE_PER_CHANNEL,
+    "chat.postEphemeral": TIER_4,
+    "conversations.history": TIER_3,
+    "conversations.invite": TIER_3,
+    "conversations.list": TIER_2,
+    "conversations.members": TIER_4,
+    "conversations.open": TIER_3,
+    "users.info": TIER_4,
+    "users.list": TIER_2,
+    "users.lookupByEmail": TIER_3,
+    "views.open": TIER_4,
+}
+DEFAULT_TIER = TIER_3
+
+# トークンを1つ予約する。戻り値は{状態, 秒数}。
+# "ok": 予約できた。秒数は予約したトークンが使えるようになるまでの時間(0ならすぐ送れる)。
+#       トークンを先に減らす(マイナスにもなる)ので、同時に待っているリクエストは1つずつずれた時刻に送られる。
+# "full": 待ち時間がARGV[3]秒を超えるので予約しなかった。
+# "blocked": Retry-Afterで止められている。秒数はその残り時間。
+TOKEN_BUCKET_SCRIPT = """
+local now_parts = redis.call('TIME')
+local now = tonumber(now_parts[1]) + tonumber(now_parts[2]) / 1000000
+local blocked_until = tonumber(redis.call('GET', KEYS[2]) or '0')
+if blocked_until > now then
+    return {'blocked', tostring(blocked_until - now)}
+end
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local max_wait = tonumber(ARGV[3])
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1]) or capacity
+local ts = tonumber(state[2]) or now
+tokens = math.min(capacity, tokens + (now - ts) * rate)
+local wait = 0
+if tokens < 1 then
+    wait = (1 - tokens) / rate
+end
+if wait > max_wait then
+    return {'full', tostring(wait)}
+end
+tokens = tokens - 1
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil((capacity - tokens) / rate) + 1)
+return {'ok', tostring(wait)}
+"""
+
+
+class RateLimitWaitTimeout(Exception):
+    """SLACK_RATE_LIMIT_MAX_WAIT秒以内にトークンが取れなかった。制限を超えて送らないよう、呼び出しを失敗させる。"""
+
+    def __init__(self, method, wait):
+        super().__init__(f"Slack API {method} is rate limited for another {wait:.1f}s (max wait: {setting.SLACK_RATE_LIMIT_MAX_WAIT}s)")
+        self.method = method
+        self.wait = wait
+
+
+class SlackRateLimiter:
+    key_prefix = "slack_rate_limit:"
+
+    def __init__(self, max_wait=setting.SLACK_RATE_LIMIT_MAX_WAIT, enabled=setting.SLACK_RATE_LIMIT_ENABLED):
+        self.max_wait = max_wait
+        self.enabled = enabled
+        self.script = None
+
+    def _keys(self, method, channel=None):
+        bucket = method
+        if method == "chat.postMessage" and channel:
+            bucket = f"{method}:{channel}"
+        return f"{self.key_prefix}bucket:{bucket}", f"{self.key_prefix}blocked:{method}"
+
+    def reserve(self, method, channel=None, max_wait=None):
+        """
+        トークンを1つ予約する。
+        Returns:
+            (str, float): ("ok" | "full" | "blocked", 秒数)。TOKEN_BUCKET_SCRIPTを参照。
+        """
+        if not self.enabled:
+            return "ok", 0
+        per_minute = METHOD_TIERS.get(method, DEFAULT_TIER)
+        capacity = max(1, per_minute // 10)
+        max_wait = self.max_wait if max_wait is None else max_wait
+        try:
+            if self.script is None:
+                self.script = get_redis().register_script(TOKEN_BUCKET_SCRIPT)
+            status, wait = self.script(keys=self._keys(method, channel), args=[capacity, per_minute / 60, max_wait])
+            return status, float(wait)
+        except redis.RedisError as e:
+            # Redisが使えない場合は制限せずに送る(429はリトライハンドラで処理される)。
+            logger.warning("Rate limiter is unavailable: %s", e)
+            return "ok", 0
+
+    def _next_step(self, method, channel, waited):
+        """次に待つ秒数と、それが予約したトークンを待つものか(待ったら送る)を返す。待てない場合はRateLimitWaitTimeout。"""
+        status, wait = self.reserve(method, channel, max_wait=self.max_wait - waited)
+        if status == "ok":
+            return wait, True
+        if status == "full" or waited + wait > self.max_wait:
+            raise RateLimitWaitTimeout(method, wait)
+        return wait, False
+
+    def acquire(self, method, channel=None):
+        """トークンを予約して、使えるようになるまで待つ。待った秒数を返す。"""
+        waited = 0
+        while True:
+            wait, reserved = self._next_step(method, channel, waited)
+            if wait > 0:
+                time.sleep(wait)
+                waited += wait
+            if reserved:
+                return waited
+
+    async def acquire_async(self, method, channel=None):
+        waited = 0
+        while True:
+            wait, reserved = await asyncio.to_thread(self._next_step, method, channel, waited)
+            if wait > 0:
+                await asyncio.sleep(wait)
+                waited += wait
+            if reserved:
+                return waited
+
+    def block(self, method, retry_after):
+        """Slackから429(Retry-After)が返ってきたメソッドを、全てのプロセスでretry_after秒間止める。"""
+        try:
+            client = get_redis()
+            now_seconds, now_micros = client.time()
+            blocked_until = now_seconds + now_micros / 1000000 + retry_after
+            client.set(self._keys(method)[1], blocked_until, px=int(retry_after * 1000))
+        except redis.RedisError as e:
+            logger.warning("Failed to share Retry-After for %s: %s", method, e)
+
+
+rate_limiter = SlackRateLimiter()
+
+
+def request_channel(kwargs):
+    """api_callの引数から、送信先のチャンネルを取り出す。"""
+    for key in ("json", "params", "data"):
+        payload = kwargs.get(key)
+        if isinstance(payload, dict) and payload.get("channel"):
+            return payload["channel"]
+    return None
+
+
+def _retry_after(response):
+    for name, values in (response.headers or {}).items():
+        if name.lower() == "retry-after":
+            return int(values[0] if isinstance(values, list) else values)
+    return 1
+
+
+class SharedRateLimitErrorRetryHandler(RateLimitErrorRetryHandler):
+    """429のRetry-Afterに従って待ってから再送し、Retry-Afterを他のプロセスにも共有する。"""
+
+    def prepare_for_next_attempt(self, *, state, request, response=None, error=None):
+        if response is not None:
+            rate_limiter.block(request.url.rsplit("/", 1)[-1], _retry_after(response))
+        super().prepare_for_next_attempt(state=state, request=request, response=response, error=error)
+
+
+class AsyncSharedRateLimitErrorRetryHandler(AsyncRateLimitErrorRetryHandler):
+    async def prepare_for_next_attempt_async(self, *, state, request, response=None, error=None):
+        if response is not None:
+            await asyncio.to_thread(rate_limiter.block, request.url.rsplit("/", 1)[-1], _retry_after(response))
+        await super().prepare_for_next_attempt_async(state=state, request=request, response=response, error=error)
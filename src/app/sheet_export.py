@@ -0,0 +1,182 @@
+"""
+対話のエクスポート(save_dialogue)で送る spreadsheets.batchUpdate のリクエストを組み立てる。
+APIは呼ばないので、組み立てたpayloadはオフラインで確認できる。
+"""
+import math
+import zlib
+import setting
+
+MESSAGE_COLUMN_WIDTH = 700
+REASON_COLUMN_WIDTH = 500
+# lie(E), suspicious(F)カラム
+CHECKBOX_COLUMNS = (4, 5)
+CHECKBOX_RULE = {
+    "condition": {"type": "BOOLEAN", "values": [{"userEnteredValue": "TRUE"}, {"userEnteredValue": "FALSE"}]},
+    "showCustomUi": True,
+}
+
+
+def new_sheet_id(title, existing_sheet_ids=()):
+    """タイトルから決まるsheetIdを返す。既存のsheetIdと重なる場合はずらす。"""
+    sheet_id = zlib.crc32(title.encode()) & 0x7FFFFFFF
+    while sheet_id in existing_sheet_ids:
+        sheet_id = (sheet_id + 1) & 0x7FFFFFFF
+    return sheet_id
+
+
+def grid_range(sheet_id, start_row=None, end_row=None, start_col=None, end_col=None):
+    """0始まり・終端を含まないインデックスでGridRangeを作る。Noneの場合はその方向に制限しない。"""
+    grid = {"sheetId": sheet_id}
+    for key, value in (("startRowIndex", start_row), ("endRowIndex", end_row), ("startColumnIndex", start_col), ("endColumnIndex", end_col)):
+        if value is not None:
+            grid[key] = value
+    return grid
+
+
+def cell_data(value):
+    # numpyの型(np.bool_, np.int64など)はPythonの型に戻す。
+    if hasattr(value, "item"):
+        value = value.item()
+    if isinstance(value, bool):
+        return {"userEnteredValue": {"boolValue": value}}
+    if isinstance(value, (int, float)):
+        if isinstance(value, float) and math.isnan(value):
+            return {}
+        return {"userEnteredValue": {"numberValue": value}}
+    if value is None:
+        return {}
+    return {"userEnteredValue": {"stringValue": str(value)}}
+
+
+def row_data(values):
+    return {"values": [cell_data(value) for value in values]}
+
+
+def dataframe_rows(df, header=True):
+    rows = [row_data(df.columns)] if header else []
+    rows.extend(row_data(values) for values in df.itertuples(index=False, name=None))
+    return rows
+
+
+def protected_range(a1_range, grid, editors):
+    return {
+        "addProtectedRange": {
+            "protectedRange": {
+                "range": grid,
+                "description": a1_range,
+                "editors": {"users": editors},
+            }
+        }
+    }
+
+
+def build_dialogue_export_requests(game_info, df, sheet_id, new_sheet=True, protected_range_ids=()):
+    """
+    対話データ(df)をworksheetに書き出すためのbatchUpdateリクエストのリストを返す。
+
+    Args:
+        game_info (GameInfoTable): ゲーム情報。タイトル、編集権限に使う。
+        df (pd.DataFrame): ts, user, role, message, lie, suspicious, reason カラムのDataFrame
+        sheet_id (int): 書き出し先のsheetId
+        new_sheet (bool): Trueの場合はworksheetを追加する。Falseの場合は既存のworksheetをクリアして上書きする。
+        protected_range_ids (list): 既存のworksheetに設定されている保護範囲のID。上書き前に削除する。
+
+    Returns:
+        list: spreadsheets.batchUpdateのrequests
+    """
+    row_count = max(len(df.index) + 1, 2)
+    col_count = len(df.columns)
+    grid_properties = {"rowCount": row_count, "columnCount": col_count, "frozenRowCount": 1}
+
+    requests = [{"deleteProtectedRange": {"protectedRangeId": range_id}} for range_id in protected_range_ids]
+    if new_sheet:
+        requests.append({"addSheet": {"properties": {"sheetId": sheet_id, "title": game_info.channel_name, "gridProperties": grid_properties}}})
+    else:
+        requests.append({"updateCells": {"range": grid_range(sheet_id), "fields": "*"}})
+        requests.append({
+            "updateSheetProperties": {
+                "properties": {"sheetId": sheet_id, "gridProperties": grid_properties},
+                "fields": "gridProperties(rowCount,columnCount,frozenRowCount)",
+            }
+        })
+
+    # 値の書き込み
+    requests.append({
+        "updateCells": {
+            "start": {"sheetId": sheet_id, "rowIndex": 0, "columnIndex": 0},
+            "rows": dataframe_rows(df),
+            "fields": "userEnteredValue",
+        }
+    })
+
+    # ヘッダーのフォーマッティング
+    requests.append({
+        "repeatCell": {
+            "range": grid_range(sheet_id, 0, 1),
+            "cell": {"userEnteredFormat": {"textFormat": {"bold": True}}},
+            "fields": "userEnteredFormat.textFormat.bold",
+        }
+    })
+
+    # message(D), reason(G)カラムの幅と折り返し
+    for col, width in ((3, MESSAGE_COLUMN_WIDTH), (6, REASON_COLUMN_WIDTH)):
+        requests.append({
+            "updateDimensionProperties": {
+                "range": {"sheetId": sheet_id, "dimension": "COLUMNS", "startIndex": col, "endIndex": col + 1},
+                "properties": {"pixelSize": width},
+                "fields": "pixelSize",
+            }
+        })
+        requests.append({
+            "repeatCell": {
+                "range": grid_range(sheet_id, start_col=col, end_col=col + 1),
+                "cell": {"userEnteredFormat": {"horizontalAlignment": "LEFT", "wrapStrategy": "WRAP"}},
+                "fields": "userEnteredFormat(horizontalAlignment,wrapStrategy)",
+            }
+        })
+
+    # lie(E), suspicious(F)カラムのTrue, Falseをチェックボックスに。
+    # 入力規則は設定した時点の行にだけかかるので、追記する行にはbuild_dialogue_append_requestsで付ける。
+    for col in CHECKBOX_COLUMNS:
+        requests.append({
+            "setDataValidation": {
+                "range": grid_range(sheet_id, 1, None, col, col + 1),
+                "rule": CHECKBOX_RULE,
+            }
+        })
+
+    # 編集制限。endRowIndexを指定しない(行方向に制限しない)保護範囲は、
+    # あとから追加した行も含むので、追記した行にも同じ制限がかかる。
+    staff = setting.STAFF_BOT_ID_GMAILS
+    lie_range = protected_range("E2:E", grid_range(sheet_id, 1, None, 4, 5), staff + [game_info.sales_email])
+    suspicious_range = protected_range("F2:F", grid_range(sheet_id, 1, None, 5, 6), staff + [game_info.customer_email])
+    if game_info.is_liar:  # 詐欺師の場合のみ嘘の発話をアノテーション出来る
+        reason_range = protected_range("G2:G", grid_range(sheet_id, 1, None, 6, 7), staff + [game_info.customer_email, game_info.sales_email])
+        requests.extend([lie_range, reason_range, suspicious_range])
+    else:
+        reason_range = protected_range("G2:G", grid_range(sheet_id, 1, None, 6, 7), staff + [game_info.customer_email])
+        requests.extend([suspicious_range, reason_range])
+
+    requests.append(protected_range("A1:D", grid_range(sheet_id, 0, None, 0, 4), staff))
+    requests.append(protected_range("A1:F1", grid_range(sheet_id, 0, 1, 0, 6), staff))
+    return requests
+
+
+def build_dialogue_append_requests(df, sheet_id):
+    """
+    既存のworksheetの末尾に対話データ(df)を追記するbatchUpdateリクエストのリストを返す。
+    lie, suspicious カラムのセルには、全体の書き出しと同じチェックボックスの入力規則を付ける。
+    """
+    if len(df.index) == 0:
+        return []
+    rows = dataframe_rows(df, header=False)
+    for row in rows:
+        for col in CHECKBOX_COLUMNS:
+            row["values"][col]["dataValidation"] = CHECKBOX_RULE
+    return [{
+        "appendCells": {
+            "sheetId": sheet_id,
+            "rows": rows,
+            "fields": "userEnteredValue,dataValidation",
+        }
+    }]
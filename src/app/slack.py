@@ -1,11 +1,126 @@
+import sys
+import json
+import time
+import queue
+import logging
+import threading
+import redis
+import aiohttp
+from cachetools import TTLCache
 from slack_sdk import WebClient
+from slack_sdk.web.async_client import AsyncWebClient
+from src.db.cache import get_redis
+from src.app.metrics import metrics
+from src.app.utils import reset_in_forked_child
+from src.app.ratelimit import rate_limiter, request_channel, SharedRateLimitErrorRetryHandler, AsyncSharedRateLimitErrorRetryHandler
 import setting
-import logging
+
+logger = logging.getLogger(__name__)
+
+# webプロセスが受け取ったuser_changeイベントを、ワーカーのプロフィールキャッシュに伝えるRedisのチャンネル
+USER_CHANGE_CHANNEL = "slack:user_change"
+# member_joined_channel / channel_created / team_joinイベントを、ワーカーのメンバー・チャンネルキャッシュに伝えるRedisのチャンネル
+MEMBERSHIP_CHANGE_CHANNEL = "slack:membership_change"
 
 
 class SlackClientWrapper(WebClient):
     def __init__(self):
-        super().__init__(token=setting.SLACK_BOT_TOKEN)
+        super().__init__(token=setting.SLACK_BOT_TOKEN, base_url=setting.SLACK_API_URL)
+        self.retry_handlers.append(SharedRateLimitErrorRetryHandler(max_retry_count=setting.SLACK_RATE_LIMIT_MAX_RETRIES))
+        # user_id -> users.infoのuser, email -> user_id (TTL付きのLRU)
+        self.profiles = TTLCache(maxsize=setting.SLACK_PROFILE_CACHE_MAXSIZE, ttl=setting.SLACK_PROFILE_CACHE_TTL)
+        self.email_user_ids = TTLCache(maxsize=setting.SLACK_PROFILE_CACHE_MAXSIZE, ttl=setting.SLACK_PROFILE_CACHE_TTL)
+        # ワークスペースのメンバーID、チャンネル一覧、チャンネルのメンバーIDを短時間だけキャッシュする。
+        self.memberships = TTLCache(maxsize=setting.SLACK_MEMBERSHIP_CACHE_MAXSIZE, ttl=setting.SLACK_MEMBERSHIP_CACHE_TTL)
+        self._reset()
+        reset_in_forked_child(self._reset)
+
+    def _reset(self):
+        # 購読スレッドは子プロセスに引き継がれないので、最初に使うときに立て直す。ロックも作り直す。
+        self.profile_lock = threading.RLock()
+        # キャッシュのキー -> 読み込み中のロック。同じ一覧の読み込みだけをまとめ、別のキーは並行に読み込む。
+        self.membership_load_locks = {}
+        self.listening = False
+
+    def api_call(self, api_method, **kwargs):
+        # Tierごとのレート制限を超えないよう、トークンが取れるまで待ってから送る。
+        waited = rate_limiter.acquire(api_method, request_channel(kwargs))
+        if waited:
+            metrics.observe("slack_wait", api_method, waited)
+        with metrics.timed("slack", api_method):
+            return super().api_call(api_method, **kwargs)
+
+    def cache_user(self, user):
+        with self.profile_lock:
+            self.profiles[user["id"]] = user
+            email = user.get("profile", {}).get("email")
+            if email:
+                self.email_user_ids[email.lower()] = user["id"]
+
+    def _listen_events(self):
+        if self.listening:
+            return
+        try:
+            pubsub = get_redis().pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(**{
+                USER_CHANGE_CHANNEL: lambda message: self.cache_user(json.loads(message["data"])),
+                MEMBERSHIP_CHANGE_CHANNEL: lambda message: self.apply_membership_change(json.loads(message["data"])),
+            })
+            pubsub.run_in_thread(sleep_time=1, daemon=True, exception_handler=self._on_listener_error)
+        except redis.RedisError as e:
+            # 購読できない間はTTLで期限切れになるのを待つ。次の呼び出しでまた購読を試みる。
+            logger.warning("Failed to subscribe to Slack event channels: %s", e)
+            return
+        self.listening = True
+
+    def _on_listener_error(self, e, pubsub, thread):
+        """購読スレッドが切断されたら止めて、次の呼び出しで購読し直す。切断中のイベントは届かないので、キャッシュも捨てる。"""
+        logger.warning("Slack event listener disconnected, resubscribing on next use: %s", e)
+        thread.stop()
+        with self.profile_lock:
+            self.profiles.clear()
+            self.email_user_ids.clear()
+            self.memberships.clear()
+        self.listening = False
+
+    def apply_membership_change(self, event):
+        """member_joined_channel / channel_created / team_joinイベントに合わせてキャッシュを破棄する。"""
+        with self.profile_lock:
+            if event["type"] == "member_joined_channel":
+                self.memberships.pop(("channel_members", event.get("channel")), None)
+            elif event["type"] == "channel_created":
+                self.memberships.pop("channels", None)
+            elif event["type"] == "team_join":
+                self.memberships.pop("workspace_members", None)
+        if event["type"] == "team_join" and "user" in event:
+            self.cache_user(event["user"])
+
+    def _cached_membership(self, key, load):
+        self._listen_events()
+        with self.profile_lock:
+            value = self.memberships.get(key)
+        if value is None:
+            # 同時に期限切れを見たスレッドが、それぞれ同じ一覧を取り直さないようにする。
+            with self.profile_lock:
+                load_lock = self.membership_load_locks.setdefault(key, threading.Lock())
+            with load_lock:
+                with self.profile_lock:
+                    value = self.memberships.get(key)
+                if value is None:
+                    value = load()
+                    with self.profile_lock:
+                        self.memberships[key] = value
+        return value
+
+    def get_user(self, user_id):
+        """キャッシュになければusers.infoで1人分だけ取得する。"""
+        self._listen_events()
+        with self.profile_lock:
+            user = self.profiles.get(user_id)
+        if user is None:
+            user = self.users_info(user=user_id)['user']
+            self.cache_user(user)
+        return user
 
     def post_message(self, channel_id, message=None, blocks=None, ephermal=False, user_id=None):
         assert message or blocks, "Message or blocks must be provided"
@@ -21,42 +136,219 @@ class SlackClientWrapper(WebClient):
         channel = response['channel']['id']
         self.chat_postMessage(channel=channel, text=message, blocks=blocks)
 
+    def iter_channel_messages(self, channel_id, oldest=None, limit=1000):
+        """conversations_historyをページングしながら、メッセージを1件ずつ返す。oldestより後(oldestを含まない)のみ。"""
+        cursor = None
+        while True:
+            params = dict(channel=channel_id, limit=limit, cursor=cursor)
+            if oldest is not None:
+                params["oldest"] = oldest
+            response = self.conversations_history(**params)
+            yield from response["messages"]
+
+            if response['has_more']:
+                cursor = response['response_metadata']['next_cursor']
+            else:
+                break
+
     def get_user_id_by_email(self, email):
-        response = self.users_lookupByEmail(email=email)
-        user_id = response['user']['id']
+        """キャッシュになければusers.lookupByEmailで1人分だけ取得する。"""
+        self._listen_events()
+        with self.profile_lock:
+            user_id = self.email_user_ids.get(email.lower())
+        if user_id is None:
+            response = self.users_lookupByEmail(email=email)
+            self.cache_user(response['user'])
+            user_id = response['user']['id']
         return user_id
 
     def get_displayed_name(self, user_id):
-        response = self.users_info(user=user_id)
-        user_profile = response['user']['profile']
+        user_profile = self.get_user(user_id)['profile']
         display_name = user_profile.get('display_name') or user_profile.get('real_name')
         return display_name
 
+    def iter_pages(self, method, key, **params):
+        """cursorでページングしながら、レスポンスのkeyの要素を1件ずつ返す。"""
+        cursor = None
+        while True:
+            response = method(cursor=cursor, **params)
+            yield from response[key]
+            cursor = response.get('response_metadata', {}).get('next_cursor')
+            if not cursor:
+                break
+
+    def iter_workspace_members(self, limit=200):
+        yield from self.iter_pages(self.users_list, "members", limit=limit)
+
     def get_worckspace_members(self):
-        response = self.users_list()
-        members = response['members']
-        return members
+        return list(self.iter_workspace_members())
 
-    def get_channel_members(self, channel_id):
-        response = self.conversations_members(channel=channel_id)
-        members = response['members']
-        return members
+    def _load_workspace_members(self):
+        """users_listを1回(ページング込み)だけ呼んで、email -> user_idの辞書と、削除(無効化)されていないメンバーIDの集合を作る。"""
+        email_user_id_map = {}
+        member_ids = set()
+        for member in self.iter_workspace_members():
+            self.cache_user(member)
+            email = member.get("profile", {}).get("email")
+            if email:
+                email_user_id_map[email.lower()] = member["id"]
+            if not member.get("deleted"):
+                member_ids.add(member["id"])
+        logger.debug("Loaded %s workspace members", len(member_ids))
+        return email_user_id_map, member_ids
 
-    def get_channel_id_list(self):
-        response = self.conversations_list(types="public_channel,private_channel")
-        channels = response['channels']
-        channel_id_list = list(map(lambda x: x.get("id"), channels))
-        return channel_id_list
+    def get_workspace_member_ids(self) -> set:
+        """削除(無効化)されていないワークスペースのメンバーIDの集合。"""
+        return self._cached_membership("workspace_members", lambda: self._load_workspace_members()[1])
 
+    def get_workspace_directory(self):
+        """
+        一括招待用に、email -> user_idの辞書とメンバーIDの集合を、1回のusers_list(ページング込み)から返す。
+        メンバーIDの集合はget_workspace_member_idsのキャッシュにも入れる。
+        """
+        email_user_id_map, member_ids = self._load_workspace_members()
+        with self.profile_lock:
+            self.memberships["workspace_members"] = member_ids
+        return email_user_id_map, member_ids
+
+    def get_channel_members(self, channel_id) -> set:
+        def load():
+            return set(self.iter_pages(self.conversations_members, "members", channel=channel_id, limit=1000))
+        return self._cached_membership(("channel_members", channel_id), load)
+
+    def get_channels(self) -> list:
+        def load():
+            return list(self.iter_pages(self.conversations_list, "channels", types="public_channel,private_channel", exclude_archived=True, limit=1000))
+        return self._cached_membership("channels", load)
+
+    def get_channel_id_list(self) -> set:
+        return {channel.get("id") for channel in self.get_channels()}
+
+    def get_channel_name_id_map(self):
+        return {channel.get("name"): channel.get("id") for channel in self.get_channels()}
+
+
+class AsyncSlackClientWrapper(AsyncWebClient):
+    """
+    SlackClientWrapperの非同期版。独立したAPI呼び出し(2人へのDMなど)を並行に送るために使う。
+    aiohttpのセッションは、最初の呼び出し時に実行中のループで作って使い回す。
+    """
 
-class SlackLoggingHandler(logging.Handler):
     def __init__(self):
+        super().__init__(token=setting.SLACK_BOT_TOKEN, base_url=setting.SLACK_API_URL)
+        self.retry_handlers.append(AsyncSharedRateLimitErrorRetryHandler(max_retry_count=setting.SLACK_RATE_LIMIT_MAX_RETRIES))
+
+    async def api_call(self, api_method, **kwargs):
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=setting.SLACK_HTTP_POOL_SIZE))
+        waited = await rate_limiter.acquire_async(api_method, request_channel(kwargs))
+        if waited:
+            metrics.observe("slack_wait", api_method, waited)
+        with metrics.timed("slack", api_method):
+            return await super().api_call(api_method, **kwargs)
+
+    async def post_message(self, channel_id, message=None, blocks=None, ephermal=False, user_id=None):
+        assert message or blocks, "Message or blocks must be provided"
+
+        if ephermal:
+            assert user_id, "User id must be provided when you send ephermal message"
+            await self.chat_postEphemeral(channel=channel_id, user=user_id, text=message, blocks=blocks)
+        else:
+            await self.chat_postMessage(channel=channel_id, text=message, blocks=blocks)
+
+    async def send_direct_message(self, user_id, message=None, blocks=None):
+        response = await self.conversations_open(users=user_id)
+        channel = response['channel']['id']
+        await self.chat_postMessage(channel=channel, text=message, blocks=blocks)
+
+
+class SlackLoggingHandler(logging.Handler):
+    """
+    ERROR以上のログをERROR_CHANNELに送る。emitはキューに積むだけで、送信はバックグラウンドのスレッドが行う。
+    interval秒の間に積まれたログは1つのメッセージにまとめ、同じ内容のログは件数を付けて1つにする。
+    キューがいっぱいの場合は、ログを呼び出し元で待たせずに捨てる(捨てた件数は次のメッセージに書く)。
+    """
+    # chat.postMessageのtextの上限(40000文字)に余裕を持たせた長さ
+    max_text_length = 39000
+
+    def __init__(self, interval=setting.SLACK_LOG_INTERVAL, queue_size=setting.SLACK_LOG_QUEUE_SIZE):
         logging.Handler.__init__(self)
         self.channel = setting.ERROR_CHANNEL
-        self.client = WebClient(setting.SLACK_BOT_TOKEN)
+        self.client = WebClient(setting.SLACK_BOT_TOKEN, base_url=setting.SLACK_API_URL)
+        self.client.retry_handlers.append(SharedRateLimitErrorRetryHandler(max_retry_count=setting.SLACK_RATE_LIMIT_MAX_RETRIES))
         self.level = logging.ERROR
+        self.interval = interval
+        self.queue_size = queue_size
+        self._reset()
+        reset_in_forked_child(self._reset)
+
+    def _reset(self):
+        # 送信スレッドは子プロセスに引き継がれないので、最初のログでキューと一緒に作り直す。
+        self.queue = None
+        self.dropped = 0
+        self.sender_lock = threading.Lock()
+
+    def _start_sender(self):
+        if self.queue is not None:
+            return
+        with self.sender_lock:
+            if self.queue is not None:
+                return
+            entries = queue.Queue(maxsize=self.queue_size)
+            threading.Thread(target=self._send_loop, args=(entries,), name="slack-logging", daemon=True).start()
+            self.queue = entries
 
     def emit(self, record):
-        if record.levelno >= self.level:
-            log_entry = self.format(record)
-            self.client.chat_postMessage(channel=self.channel, text=log_entry)
\ No newline at end of file
+        if record.levelno < self.level:
+            return
+        try:
+            self._start_sender()
+            self.queue.put_nowait(self.format(record))
+        except queue.Full:
+            self.dropped += 1
+        except Exception:
+            self.handleError(record)
+
+    def _send_loop(self, entries):
+        while True:
+            batch = {entries.get(): 1}
+            deadline = time.monotonic() + self.interval
+            while (remaining := deadline - time.monotonic()) > 0:
+                try:
+                    entry = entries.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                batch[entry] = batch.get(entry, 0) + 1
+            self._send(batch)
+
+    def _drain(self):
+        batch = {}
+        while self.queue is not None:
+            try:
+                entry = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            batch[entry] = batch.get(entry, 0) + 1
+        return batch
+
+    def _send(self, batch):
+        dropped, self.dropped = self.dropped, 0
+        lines = [entry if count == 1 else f"(x{count}) {entry}" for entry, count in batch.items()]
+        if dropped:
+            lines.append(f"(送信待ちのログが多すぎるため、{dropped}件を破棄しました)")
+        if not lines:
+            return
+        text = "\n".join(lines)
+        if len(text) > self.max_text_length:
+            text = text[:self.max_text_length] + "\n..."
+        try:
+            self.client.chat_postMessage(channel=self.channel, text=text)
+        except Exception as e:
+            # このハンドラ自身に戻ってこないよう、loggingは使わない。
+            sys.stderr.write(f"Failed to send logs to Slack: {e}\n")
+
+    def close(self):
+        # 終了時に、まだ送っていないログを送る。
+        if self.queue is not None:
+            self._send(self._drain())
+        logging.Handler.close(self)
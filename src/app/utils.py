@@ -1,5 +1,11 @@
+import os
 import datetime
 import pytz
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import pandas as pd
+
 
 def unix_to_jst(unix_time):
     utc_datetime = datetime.datetime.utcfromtimestamp(unix_time)
@@ -8,5 +14,22 @@ def unix_to_jst(unix_time):
     return jst_str
 
 
+def unix_to_jst_series(unix_times: "pd.Series") -> "pd.Series":
+    """unix_to_jstのSeries版。applyを使わずにまとめて変換する。"""
+    import pandas as pd
+    jst_datetimes = pd.to_datetime(unix_times.astype(float), unit="s", utc=True).dt.tz_convert("Asia/Tokyo")
+    return jst_datetimes.dt.strftime('%Y-%m-%d %H:%M:%S')
+
+
+def reset_in_forked_child(reset):
+    """
+    forkされた子プロセスで、resetを呼ぶように登録する。
+    Celeryのワーカーはforkされるので、スレッド・イベントループ・コネクションプールなど親プロセスと共有できないものは、
+    resetで破棄して、子プロセスで初めて使うときに作り直す。
+    """
+    os.register_at_fork(after_in_child=reset)
+    return reset
+
+
 def str_to_bool(value):
     return value.lower() == "true"
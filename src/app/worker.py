@@ -1,48 +1,61 @@
-import os
-import traceback
 import setting
-import pandas as pd
+import gspread
 import logging
-from celery import Celery
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from celery.signals import worker_init
 from celery.utils.log import get_task_logger
-from slack_sdk.errors import SlackApiError
-from src.app.utils import unix_to_jst
 from src.app.messages import (start_message_block, role_instruction_block,
                                 judge_receipt_message, ask_annotation_block, to_honest_sales_message,
                                 command_confirmation_message, thank_you_for_annotation_message, 
-                                on_open_spreadsheet_block, final_result_announcement_block)
+                                on_open_spreadsheet_block, final_result_announcement_block,
+                                bulk_invite_summary_message, master_reload_report_message)
 from src.db.game_info import GameInfoDB
-from src.app.slack import SlackClientWrapper
-from src.app.gsheet import GSheetClientWrapper
-from src.app.utils import unix_to_jst, str_to_bool
-from logger_config import setup_loggers
+from src.db.cache import MessageCaptureSession
+from src.app.slack import SlackClientWrapper, AsyncSlackClientWrapper
+from src.app.aio import AsyncRunner
+from src.app.metrics import task_context, format_summary
+from src.app.gsheet import get_gsheet_client, MasterSheetWriteQueue, DialogueExportState
+from src.app.utils import unix_to_jst_series, str_to_bool
+from src.app.celery_app import celery
+from logger_config import setup_loggers, summarize
 
 slack_client = SlackClientWrapper()
-gsheet_client = GSheetClientWrapper()
-
-celery = Celery(__name__)
-celery.conf.broker_url = os.environ.get("CELERY_BROKER_URL", "redis://localhost:6379")
-celery.conf.result_backend = os.environ.get("CELERY_RESULT_BACKEND", "redis://localhost:6379")
+# 独立したSlack APIの呼び出しを並行に送るための非同期クライアント
+async_slack_client = AsyncSlackClientWrapper()
+async_runner = AsyncRunner()
+master_sheet_write_queue = MasterSheetWriteQueue()
+dialogue_export_state = DialogueExportState()
+message_capture = MessageCaptureSession()
 
 #logger = get_task_logger(__name__)
 logger = logging.getLogger(__name__)
 logger = setup_loggers(logger)
 
-game_info_db = GameInfoDB().get_instance()
+# エンジンを作るだけで、DBへの接続は最初のクエリまで行わない。
+game_info_db = GameInfoDB.get_instance()
+
+
+@worker_init.connect
+def create_tables(**kwargs):
+    game_info_db.create_table()
+    # fork前の親プロセスで使ったコネクションを、子プロセスに引き継がないようにする。
+    game_info_db.engine.dispose()
 
 MASTER_JUDGE_COL_INDEX = 5
 MASTER_REASON_COL_INDEX = 6
 MASTER_FINISH_COL_INDEX = 8
-CELERY_TIME_LIMIT = 300
 
 def handle_errors(func):
     def wrapper(*args, **kwargs):
-        body = args[0]
+        body = args[0] if args else {}
         channel_id = body.get("channel_id", None)
         command = body.get("command", None)
         
         try:
-            return func(*args, **kwargs)
+            # タスクの所要時間と結果を記録し、実行中の外部呼び出しをこのタスクのものとして集計する。
+            with task_context(func.__name__):
+                return func(*args, **kwargs)
 
         except Exception as e:
             message = f"Error occurred in function {func.__name__}: {e}"
@@ -51,91 +64,235 @@ def handle_errors(func):
             if channel_id:
                 message = f"<#{channel_id}>" + message
                 
-            logger.error(message)
-            logger.error(traceback.format_exc())
+            # メッセージとトレースバックを1件のログにする(Slackにも1件として送られる)。
+            logger.error(message, exc_info=True)
 
     return wrapper
 
 
+def save_to_master_sheet(updates, channel_id):
+    """
+    (行番号, 列番号, 値)のリストをMasterスプレッドシートに書き込む。
+    MASTER_SHEET_FLUSH_INTERVALが設定されていれば、flush_master_sheet_task(celery beat)がまとめて書き込む。
+    """
+    if setting.MASTER_SHEET_FLUSH_INTERVAL > 0:
+        master_sheet_write_queue.enqueue(updates, channel_id=channel_id)
+    else:
+        get_gsheet_client().save_values_to_master_sheet(updates)
+
+
+@celery.task(name="flush_master_sheet_task", soft_time_limit=setting.CELERY_ADMIN_SOFT_TIME_LIMIT, time_limit=setting.CELERY_ADMIN_TIME_LIMIT)
+@handle_errors
+def flush_master_sheet_task():
+    master_sheet_write_queue.flush(get_gsheet_client())
+
+
+@celery.task(name="log_metrics_task", soft_time_limit=setting.CELERY_ADMIN_SOFT_TIME_LIMIT, time_limit=setting.CELERY_ADMIN_TIME_LIMIT)
+@handle_errors
+def log_metrics_task():
+    logger.info("Metrics summary\n%s", format_summary())
+
+
 """`/invite_players` command"""
-@celery.task(name="invite_players_task", time_limit=CELERY_TIME_LIMIT)
+@celery.task(name="invite_players_task", soft_time_limit=setting.CELERY_ADMIN_SOFT_TIME_LIMIT, time_limit=setting.CELERY_ADMIN_TIME_LIMIT)
 @handle_errors
 def invite_players_task(body):
     channel_id = body.get("channel_id")
     
-    logger.debug(f"channel_id: {channel_id}")
+    logger.debug("channel_id: %s", channel_id)
     
     channel_id_list = slack_client.get_channel_id_list()
-    logger.debug(f"Channel ids in this workspace: {channel_id_list}")
+    logger.debug("Number of channels in this workspace: %s", len(channel_id_list))
     if channel_id not in channel_id_list:
-        raise ValueError(f"チャンネル<#{channel_id}>が存在しません。作成してください。\n存在するチャンネルのID: {channel_id_list}")
+        raise ValueError(f"チャンネル<#{channel_id}>が存在しません。作成してください。")
     slack_client.post_message(message=command_confirmation_message(body=body), channel_id=channel_id, user_id=body['user_id'], ephermal=True)
     
-    master_data, master_row_index = gsheet_client.get_master_data(body, return_row_index=True)
-    customer_email = master_data.get("customer_email")
-    sales_email = master_data.get("sales_email")
-    customer_id = slack_client.get_user_id_by_email(customer_email)
-    sales_id = slack_client.get_user_id_by_email(sales_email)
-    case_id = master_data.get("case_id")
-    
-    workplace_members = slack_client.get_worckspace_members()
-    logger.debug(f"Members in this workspace: {workplace_members}")
-    if customer_id in workplace_members:
-        raise SlackApiError(f"Customer <@{customer_id}> is already in this workspace.")
-    if sales_id in workplace_members:
-        raise SlackApiError(f"Sales <@{sales_id}> is already in this workspace.")
-    
-    game_info = dict(
+    master_data, master_row_index = get_gsheet_client().get_master_data(body, return_row_index=True)
+    emails = [master_data.get("customer_email"), master_data.get("sales_email")]
+    email_user_id_map = {str(email).lower(): slack_client.get_user_id_by_email(email) for email in emails}
+    customer_id, sales_id = resolve_players(master_data, email_user_id_map, slack_client.get_workspace_member_ids())
+
+    # 既に参加している場合は、登録済みのgame_infoを上書きする前にエラーにする。招待できたら登録する。
+    invite_to_channel(channel_id, customer_id, sales_id)
+
+    game_info = build_game_info(channel_id, body.get("channel_name"), master_data, master_row_index, customer_id, sales_id)
+    game_info = game_info_db.save_game_info(**game_info)
+    dialogue_export_state.clear(channel_id)
+    logger.info("Saved game info: %s", game_info)
+
+
+def resolve_players(master_data, email_user_id_map, workspace_member_ids):
+    """
+    Masterの行の客役・営業役のemailをuser_idにし、招待できるかを確認する。
+    `/invite_players` と `/invite_players all` の両方で使い、問題があればValueErrorにする。
+
+    Args:
+        master_data (dict): Masterスプレッドシートの行
+        email_user_id_map (dict): 小文字のemail -> user_id
+        workspace_member_ids (set): 有効なワークスペースのメンバーID
+
+    Returns:
+        (customer_id, sales_id)
+    """
+    player_ids = []
+    for role, label in (("customer", "Customer"), ("sales", "Sales")):
+        email = master_data.get(f"{role}_email")
+        user_id = email_user_id_map.get(str(email).lower())
+        if user_id is None:
+            raise ValueError(f"{label}のメールアドレス({email})がワークスペースに存在しません。")
+        if user_id in setting.STAFF_BOT_IDS:
+            raise ValueError(f"{label} <@{user_id}> はスタッフまたはbotです。プレイヤーには指定できません。")
+        if user_id not in workspace_member_ids:
+            raise ValueError(f"{label} <@{user_id}> is not an active member of this workspace.")
+        player_ids.append(user_id)
+
+    customer_id, sales_id = player_ids
+    if customer_id == sales_id:
+        raise ValueError(f"客役と営業役が同じユーザー(<@{customer_id}>)です。")
+    return customer_id, sales_id
+
+
+def build_game_info(channel_id, channel_name, master_data, master_row_index, customer_id, sales_id):
+    return dict(
         channel_id=channel_id,
-        channel_name=body.get("channel_name"),
-        customer_email=customer_email,
-        sales_email=sales_email,
+        channel_name=channel_name,
+        customer_email=master_data.get("customer_email"),
+        sales_email=master_data.get("sales_email"),
         customer_id=customer_id,
         sales_id=sales_id,
-        case_id = case_id,
+        case_id=master_data.get("case_id"),
         is_liar=str_to_bool(master_data.get("is_liar")),
         master_row_index=int(master_row_index),
         is_started=False,
     )
-    
-    game_info = game_info_db.save_game_info(**game_info)
-    
-    if isinstance(game_info, Exception):
-        raise game_info
-    else:
-        logger.info(f"Saved game info: {game_info}")
 
+
+def invite_to_channel(channel_id, customer_id, sales_id):
+    """既に参加している場合はValueErrorにし、招待しない。"""
     members = slack_client.get_channel_members(channel_id)
-    logger.debug(f"Members in <#{channel_id}>: {members}")
+    logger.debug("Number of members in <#%s>: %s", channel_id, len(members))
     if customer_id in members:
-        raise SlackApiError(f"Customer(<@{customer_id}>) is already in the channel<#{channel_id}>.")
+        raise ValueError(f"Customer(<@{customer_id}>) is already in the channel<#{channel_id}>.")
     if sales_id in members:
-        raise SlackApiError(f"Sales(<@{sales_id}>) is already in the channel<#{channel_id}>.")
-    
+        raise ValueError(f"Sales(<@{sales_id}>) is already in the channel<#{channel_id}>.")
+
     slack_client.conversations_invite(channel=channel_id, users=f"{customer_id},{sales_id}")
 
 
+"""`/invite_players all` | `/invite_players {channel_name} ...` command"""
+@celery.task(name="invite_players_bulk_task", soft_time_limit=setting.CELERY_BULK_SOFT_TIME_LIMIT, time_limit=setting.CELERY_BULK_TIME_LIMIT)
+@handle_errors
+def invite_players_bulk_task(body):
+    """
+        Masterスプレッドシート、チャンネル一覧、メンバー一覧をそれぞれ1回だけ取得して、
+        複数チャンネルへの招待をまとめて行う。最後に結果を1つのメッセージで報告する。
+    """
+    channel_id = body.get("channel_id")
+    invoked_user_id = body.get("user_id")
+    slack_client.post_message(message=command_confirmation_message(body=body), channel_id=channel_id, user_id=invoked_user_id, ephermal=True)
+
+    master_index = get_gsheet_client().get_master_index()
+
+    target_channel_names = body.get("text", "").replace(",", " ").split()
+    if target_channel_names == ["all"]:
+        target_channel_names = list(master_index["rows"]) + master_index["duplicates"]
+
+    channel_name_id_map = slack_client.get_channel_name_id_map()
+    email_user_id_map, workspace_member_ids = slack_client.get_workspace_directory()
+
+    failures = {}
+    candidates = []
+    for channel_name in target_channel_names:
+        if channel_name in master_index["duplicates"]:
+            failures[channel_name] = "スプレッドシートにチャンネル名が重複して存在しています。"
+            continue
+        if channel_name not in master_index["rows"]:
+            failures[channel_name] = "スプレッドシートにチャンネル名が存在しません。"
+            continue
+        if channel_name not in channel_name_id_map:
+            failures[channel_name] = "チャンネルが存在しません。作成してください。"
+            continue
+
+        master_data, master_row_index = master_index["rows"][channel_name]
+        try:
+            customer_id, sales_id = resolve_players(master_data, email_user_id_map, workspace_member_ids)
+        except ValueError as e:
+            failures[channel_name] = str(e)
+            continue
+        candidates.append(build_game_info(channel_name_id_map[channel_name], channel_name, master_data, master_row_index, customer_id, sales_id))
+
+    # 登録済みのチャンネルは進行中のゲームの状態を上書きしないよう、招待も登録もしない。
+    existing_channel_ids = game_info_db.get_existing_channel_ids([game_info["channel_id"] for game_info in candidates])
+    game_infos = []
+    for game_info in candidates:
+        if game_info["channel_id"] in existing_channel_ids:
+            failures[game_info["channel_name"]] = "既にゲームが登録されています。招待し直す場合は `/invite_players` をチャンネルごとに実行してください。"
+        else:
+            game_infos.append(game_info)
+
+    invited = []
+    with ThreadPoolExecutor(max_workers=setting.BULK_INVITE_CONCURRENCY) as executor:
+        futures = {
+            # 計測用のタスク名(contextvars)をスレッドに引き継ぐ。
+            executor.submit(contextvars.copy_context().run, invite_to_channel, game_info["channel_id"], game_info["customer_id"], game_info["sales_id"]): game_info
+            for game_info in game_infos
+        }
+        for future in as_completed(futures):
+            game_info = futures[future]
+            try:
+                future.result()
+                invited.append(game_info)
+            except Exception as e:
+                logger.warning("Failed to invite players to <#%s>: %s", game_info["channel_id"], e)
+                failures[game_info["channel_name"]] = str(e)
+
+    # 招待できたチャンネルだけを登録する。
+    game_info_db.save_game_infos(invited)
+    for game_info in invited:
+        dialogue_export_state.clear(game_info["channel_id"])
+    logger.info("Saved %s game infos", len(invited))
+    invited_channel_ids = [game_info["channel_id"] for game_info in invited]
+
+    slack_client.post_message(message=bulk_invite_summary_message(invoked_user_id, invited_channel_ids, failures), channel_id=channel_id, user_id=invoked_user_id, ephermal=True)
+
+
+"""`/reload_master` command"""
+@celery.task(name="reload_master_task", soft_time_limit=setting.CELERY_ADMIN_SOFT_TIME_LIMIT, time_limit=setting.CELERY_ADMIN_TIME_LIMIT)
+@handle_errors
+def reload_master_task(body):
+    channel_id = body.get("channel_id")
+    invoked_user_id = body.get("user_id")
+    master_index = get_gsheet_client().get_master_index(refresh=True)
+    get_gsheet_client().invalidate_case_index()
+    slack_client.post_message(message=master_reload_report_message(invoked_user_id, master_index), channel_id=channel_id, user_id=invoked_user_id, ephermal=True)
+
+
 """`/start` command"""
-@celery.task(name="start_task", time_limit=CELERY_TIME_LIMIT)
+@celery.task(name="start_task", soft_time_limit=setting.CELERY_ADMIN_SOFT_TIME_LIMIT, time_limit=setting.CELERY_ADMIN_TIME_LIMIT)
 @handle_errors
 def start_task(body):
-    logger.debug(f"body: {body}")
+    logger.debug("body: %s", summarize(body))
     
     channel_id = body.get("channel_id")
     slack_client.post_message(message=command_confirmation_message(body=body), channel_id=channel_id, user_id=body['user_id'], ephermal=True)
     
     game_info_db.set_started(channel_id)
+    message_capture.mark_game_started(channel_id)
     game_info = game_info_db.get_game_info(channel_id)
     
-    logger.debug(f"Game Info: {game_info}")
-    
-    slack_client.post_message(channel_id=channel_id, blocks=start_message_block(customer_id=game_info.customer_id, sales_id=game_info.sales_id))
+    logger.debug("Game Info: %s", game_info)
     
-    slack_client.send_direct_message(user_id=game_info.customer_id, blocks=role_instruction_block(channel_id=channel_id, case_id=game_info.case_id, is_liar=game_info.is_liar, role="customer"))
-    slack_client.send_direct_message(user_id=game_info.sales_id, blocks=role_instruction_block(channel_id=channel_id, case_id=game_info.case_id, is_liar=game_info.is_liar, role="sales"))
+    customer_blocks = role_instruction_block(channel_id=channel_id, case_id=game_info.case_id, is_liar=game_info.is_liar, role="customer")
+    sales_blocks = role_instruction_block(channel_id=channel_id, case_id=game_info.case_id, is_liar=game_info.is_liar, role="sales")
+    # 確認メッセージの後に送る。開始メッセージと役割のDMは別々の会話なので、順番は問わない。
+    async_runner.gather(
+        async_slack_client.post_message(channel_id=channel_id, blocks=start_message_block(customer_id=game_info.customer_id, sales_id=game_info.sales_id)),
+        async_slack_client.send_direct_message(user_id=game_info.customer_id, blocks=customer_blocks),
+        async_slack_client.send_direct_message(user_id=game_info.sales_id, blocks=sales_blocks),
+    )
 
 
-@celery.task(name="save_messages_task", time_limit=CELERY_TIME_LIMIT)
+@celery.task(name="save_messages_task", soft_time_limit=setting.CELERY_EXPORT_SOFT_TIME_LIMIT, time_limit=setting.CELERY_EXPORT_TIME_LIMIT)
 @handle_errors
 def save_messages_task(body, judge, reason):
     """
@@ -153,69 +310,108 @@ def save_messages_task(body, judge, reason):
 
     """
     
-    logger.debug(f"save_messages_task invoked. body: {body}, judge: {judge}")
+    logger.debug("save_messages_task invoked. body: %s, judge: %s", summarize(body), judge)
     
     channel_id = body['channel_id']
     invoked_user_id = body.get("user_id")
-    slack_client.post_message(message=command_confirmation_message(body=body), user_id=invoked_user_id, channel_id=channel_id, ephermal=True)        
-    
     game_info = game_info_db.get_game_info(channel_id)
     customer_id = game_info.customer_id
     sales_id = game_info.sales_id
-    
+
+    slack_client.post_message(message=command_confirmation_message(body=body), user_id=invoked_user_id, channel_id=channel_id, ephermal=True)
     slack_client.post_message(message=judge_receipt_message(user_id=customer_id), channel_id=channel_id)
     game_info_db.set_judge(channel_id=channel_id, judge=judge)
     
-    displayed_customer_name = slack_client.get_displayed_name(customer_id)
-    displayed_sales_name = slack_client.get_displayed_name(sales_id)
-    annotations = dict(ts=[], user=[], role=[], message=[], lie=[], suspicious=[], reason=[])
-    cursor = None
-    while True:
-        response = slack_client.conversations_history(
-            channel=channel_id,
-            exclude_archived=True,
-            types="message",
-            limit=1000,
-            cursor=cursor
-        )
-        
-        for message in response["messages"]:
-            if "subtype" not in message and message["user"] in [customer_id, sales_id]:
-                annotations["ts"].append(float(message['ts']))
-                annotations["user"].append(displayed_customer_name if message["user"] == customer_id else displayed_sales_name)
-                annotations["role"].append("customer" if message["user"] == customer_id else "sales")
-                annotations["message"].append(message["text"])
-                annotations["lie"].append(False)
-                annotations["suspicious"].append(False)
-                annotations["reason"].append("")
-
-        if response['has_more']:
-            cursor = response['response_metadata']['next_cursor']
-        else:
-            break
-    
-    df = pd.DataFrame.from_dict(annotations).sort_values(by="ts").reset_index(drop=True)
-    df['ts'] = df['ts'].apply(unix_to_jst)
-    logger.debug(f"df: {df}")
-    
-    worksheet_url = gsheet_client.save_dialogue(game_info=game_info, df=df)
-    logger.debug(f"worksheet_url: {worksheet_url}")
+    worksheet_url = export_dialogue(game_info)
+    logger.debug("worksheet_url: %s", worksheet_url)
     game_info_db.set_worksheet_url(channel_id=channel_id, worksheet_url=worksheet_url)
 
     if not game_info.is_liar:
         slack_client.post_message(message=to_honest_sales_message(sales_id=sales_id), user_id=sales_id, channel_id=channel_id, ephermal=True)
-        
     slack_client.post_message(blocks=ask_annotation_block(worksheet_url, game_info=game_info), channel_id=channel_id)
 
-    gsheet_client.save_value_to_master_sheet(target_row_index=game_info.master_row_index, target_col_index=MASTER_JUDGE_COL_INDEX, value=judge)
-    gsheet_client.save_value_to_master_sheet(target_row_index=game_info.master_row_index, target_col_index=MASTER_REASON_COL_INDEX, value=reason)
+    save_to_master_sheet([
+        (game_info.master_row_index, MASTER_JUDGE_COL_INDEX, judge),
+        (game_info.master_row_index, MASTER_REASON_COL_INDEX, reason),
+    ], channel_id)
 
-    game_info_db.set_customer_done(channel_id=channel_id, undo=True)
-    game_info_db.set_sales_done(channel_id=channel_id, undo=True)
+    game_info_db.reset_done(channel_id=channel_id)
     return True
 
 
-@celery.task(name="on_open_spreadsheet_task", time_limit=CELERY_TIME_LIMIT)
+DIALOGUE_COLUMNS = ["ts", "user", "role", "message", "lie", "suspicious", "reason"]
+
+
+def iter_dialogue_messages(channel_id, oldest=None):
+    """
+    ゲーム開始時からmessageイベントを途切れずに記録していればmessage_logのメッセージを、
+    そうでなければ(開始後にデプロイした、webプロセスが止まっていた・再接続したなど)conversations_historyのメッセージを返す。
+    """
+    if setting.DIALOGUE_SOURCE == "local" and message_capture.is_complete(channel_id):
+        for message in game_info_db.get_messages(channel_id, oldest=oldest):
+            yield dict(ts=message.ts, user=message.user_id, text=message.text)
+    else:
+        yield from slack_client.iter_channel_messages(channel_id, oldest=oldest)
+
+
+def fetch_dialogue(game_info, oldest=None):
+    """
+    客役・営業役のメッセージのうち、oldestより新しいものをDataFrameにする。
+
+    Returns:
+        (pd.DataFrame, str or None): 対話データと、その中で最も新しいメッセージのts
+    """
+    # pandasの読み込みは重いので、エクスポートするときまで遅らせる。
+    import pandas as pd
+
+    customer_id = game_info.customer_id
+    sales_id = game_info.sales_id
+    names = {
+        customer_id: slack_client.get_displayed_name(customer_id),
+        sales_id: slack_client.get_displayed_name(sales_id),
+    }
+
+    rows = []
+    last_ts = oldest
+    for message in iter_dialogue_messages(game_info.channel_id, oldest=oldest):
+        if "subtype" in message or message.get("user") not in names:
+            continue
+        role = "customer" if message["user"] == customer_id else "sales"
+        rows.append((message["ts"], names[message["user"]], role, message["text"], False, False, ""))
+        if last_ts is None or float(message["ts"]) > float(last_ts):
+            last_ts = message["ts"]
+
+    df = pd.DataFrame(rows, columns=DIALOGUE_COLUMNS)
+    df = df.iloc[df["ts"].astype(float).argsort(kind="stable")].reset_index(drop=True)
+    df["ts"] = unix_to_jst_series(df["ts"])
+    return df, last_ts
+
+
+def export_dialogue(game_info):
+    """
+    前回のエクスポート以降のメッセージだけを取得して、worksheetに追記する。
+    前回のエクスポートがない(またはworksheetが消された)場合は、全てのメッセージを書き出す。
+    """
+    channel_id = game_info.channel_id
+    state = dialogue_export_state.get(channel_id)
+    if state is not None:
+        df, last_ts = fetch_dialogue(game_info, oldest=state["last_ts"])
+        logger.debug("Appending %s messages to <#%s>'s worksheet", len(df.index), channel_id)
+        try:
+            worksheet_url = get_gsheet_client().append_dialogue(game_info=game_info, df=df, sheet_id=state["sheet_id"])
+            dialogue_export_state.set(channel_id, last_ts=last_ts, sheet_id=state["sheet_id"])
+            return worksheet_url
+        except gspread.exceptions.APIError as e:
+            logger.warning("Failed to append dialogue, exporting all messages: %s", e)
+
+    df, last_ts = fetch_dialogue(game_info)
+    logger.debug("df: %s", df)
+    worksheet_url = get_gsheet_client().save_dialogue(game_info=game_info, df=df)
+    dialogue_export_state.set(channel_id, last_ts=last_ts, sheet_id=int(worksheet_url.rsplit("#gid=", 1)[1]))
+    return worksheet_url
+
+
+@celery.task(name="on_open_spreadsheet_task", soft_time_limit=setting.CELERY_INTERACTIVE_SOFT_TIME_LIMIT, time_limit=setting.CELERY_INTERACTIVE_TIME_LIMIT)
 @handle_errors
 def on_open_spreadsheet_task(body):
     channel_id = body['container']['channel_id']
@@ -223,7 +419,7 @@ def on_open_spreadsheet_task(body):
     slack_client.post_message(blocks=on_open_spreadsheet_block(channel_id=channel_id, user_id=invoked_user_id), user_id=invoked_user_id, channel_id=channel_id, ephermal=True)
 
 
-@celery.task(name="on_annotation_done_task", time_limit=CELERY_TIME_LIMIT)
+@celery.task(name="on_annotation_done_task", soft_time_limit=setting.CELERY_INTERACTIVE_SOFT_TIME_LIMIT, time_limit=setting.CELERY_INTERACTIVE_TIME_LIMIT)
 @handle_errors
 def on_annotation_done_task(body):
     channel_id = body['container']['channel_id']
@@ -235,34 +431,28 @@ def on_annotation_done_task(body):
     sales_id = game_info.sales_id
     
     assert game_info.judge is not None, f"客役の<@{customer_id}>がまだ `/lie` | `/trust` コマンドを入力していないため、ゲームが終わっていません。\n `/done` コマンドはゲーム終了後に使用してください 。"
-    logger.info(f"game_info: {game_info}")
-    
-    # 営業役が詐欺師でない場合、アノテーションを要求しない。
-    if not game_info.is_liar:
-        game_info_db.set_sales_done(channel_id)
+    logger.info("game_info: %s", game_info)
     
     if invoked_user_id == customer_id:
-        if game_info.customer_done:
-            return
-        else:
-            game_info_db.set_customer_done(channel_id)
+        role = "customer"
     elif invoked_user_id == sales_id:
-        if game_info.sales_done:
-            return
-        else:
-            game_info_db.set_sales_done(channel_id)
-    
-    logger.debug(f"customer_done: {game_info.customer_done}, sales_done: {game_info.sales_done}")
-    game_info = game_info_db.get_game_info(channel_id)
-    
+        role = "sales"
+    else:
+        role = None
+
+    # 営業役が詐欺師でない場合、アノテーションを要求しない。
+    transition = game_info_db.mark_role_done(channel_id, role=role, auto_sales_done=not game_info.is_liar)
+    if not transition.changed:
+        return
+    game_info = transition.game_info
+    logger.debug("customer_done: %s, sales_done: %s", game_info.customer_done, game_info.sales_done)
+
     slack_client.post_message(channel_id=channel_id, message=thank_you_for_annotation_message(invoked_user_id), user_id=invoked_user_id, ephermal=True)
     # TODO: 編集権限をここで剥奪する。
-    
-    # 二人とも終わっていれば、結果を発表する。
-    logger.debug(f"game_info: {game_info}")
-    logger.debug(f"customer_done: {game_info.customer_done}, sales_done: {game_info.sales_done}")
-    if game_info.customer_done and game_info.sales_done:
+
+    # 二人とも終わっていれば、結果を発表する。(completedは一度しかTrueにならない)
+    if transition.completed:
         judge = game_info.judge
         is_liar = game_info.is_liar
         slack_client.post_message(blocks=final_result_announcement_block(customer_id, sales_id, is_liar, judge), channel_id=channel_id)
-        gsheet_client.save_value_to_master_sheet(target_row_index=game_info.master_row_index, target_col_index=MASTER_FINISH_COL_INDEX, value=True)
+        save_to_master_sheet([(game_info.master_row_index, MASTER_FINISH_COL_INDEX, True)], channel_id)
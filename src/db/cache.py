@@ -0,0 +1,270 @@
+import json
+import time
+import uuid
+import asyncio
+import logging
+import redis
+import redis.asyncio
+from cachetools import TTLCache
+import setting
+
+logger = logging.getLogger(__name__)
+
+GAME_INFO_INVALIDATION_CHANNEL = "game_info:invalidate"
+
+_redis = None
+_async_redis = None
+
+
+def get_redis() -> redis.Redis:
+    """プロセス内で共有するRedisクライアント(Celeryのbrokerと同じRedis)を返す。"""
+    global _redis
+    if _redis is None:
+        _redis = redis.Redis.from_url(setting.REDIS_URL, decode_responses=True)
+    return _redis
+
+
+def get_async_redis() -> redis.asyncio.Redis:
+    """webプロセス(asyncio)用のRedisクライアントを返す。"""
+    global _async_redis
+    if _async_redis is None:
+        _async_redis = redis.asyncio.Redis.from_url(setting.REDIS_URL, decode_responses=True)
+    return _async_redis
+
+
+class GameInfoCache:
+    """
+    channel_id -> game_info(dict)のRead-throughキャッシュ。
+    ワーカー間で共有するためRedisに保存し、TTLと最大件数(古いものから削除)で制限する。
+    """
+    key_prefix = "game_info:"
+    index_key = "game_info:index"
+    # 破棄(DBへの書き込み)のたびに増やすチャンネルごとのバージョン。
+    # Read-throughの書き込みは、DBを読む前と同じバージョンの場合だけ行う(その間に更新されていれば古い行になるため)。
+    version_key_prefix = "game_info:version:"
+
+    def __init__(self, ttl=setting.GAME_INFO_CACHE_TTL, maxsize=setting.GAME_INFO_CACHE_MAXSIZE):
+        self.ttl = ttl
+        self.maxsize = maxsize
+
+    def _key(self, channel_id):
+        return f"{self.key_prefix}{channel_id}"
+
+    def _version_key(self, channel_id):
+        return f"{self.version_key_prefix}{channel_id}"
+
+    def get(self, channel_id):
+        try:
+            value = get_redis().get(self._key(channel_id))
+        except redis.RedisError as e:
+            logger.warning("Failed to read game info cache: %s", e)
+            return None
+        return None if value is None else json.loads(value)
+
+    def version(self, channel_id):
+        """DBを読む前に取得し、set(version=...)に渡す。"""
+        try:
+            return get_redis().get(self._version_key(channel_id)) or ""
+        except redis.RedisError as e:
+            logger.warning("Failed to read game info cache version: %s", e)
+            return None
+
+    def set(self, channel_id, game_info: dict, version=None):
+        """
+        versionを指定した場合(Read-through)は、バージョンが変わっていなければ書き込む。
+        DBへの書き込みの後は、setではなくinvalidateを使う(並行した書き込みの古い方が残らないように)。
+        """
+        try:
+            client = get_redis()
+            if version is not None:
+                if not self._set_if_version(client, channel_id, game_info, version):
+                    return
+            else:
+                pipe = client.pipeline()
+                self._set(pipe, channel_id, game_info)
+                pipe.execute()
+            self._evict_if_needed(client)
+        except redis.RedisError as e:
+            logger.warning("Failed to write game info cache: %s", e)
+
+    def _set(self, pipe, channel_id, game_info):
+        pipe.set(self._key(channel_id), json.dumps(game_info), ex=self.ttl)
+        pipe.zadd(self.index_key, {channel_id: time.time()})
+
+    def _set_if_version(self, client, channel_id, game_info, version):
+        with client.pipeline() as pipe:
+            try:
+                pipe.watch(self._version_key(channel_id))
+                if (pipe.get(self._version_key(channel_id)) or "") != version:
+                    return False
+                pipe.multi()
+                self._set(pipe, channel_id, game_info)
+                pipe.execute()
+                return True
+            except redis.WatchError:
+                return False
+
+    def _evict_if_needed(self, client):
+        size = client.zcard(self.index_key)
+        if size > self.maxsize:
+            self._evict(client, size - self.maxsize)
+
+    def _evict(self, client, count):
+        oldest = client.zrange(self.index_key, 0, count - 1)
+        if not oldest:
+            return
+        pipe = client.pipeline()
+        pipe.delete(*[self._key(channel_id) for channel_id in oldest])
+        pipe.zrem(self.index_key, *oldest)
+        pipe.execute()
+
+    def invalidate(self, *channel_ids):
+        """
+        エントリを破棄してバージョンを上げ、webプロセスのキャッシュにも通知する。
+        次の読み込みでDBから取り直すので、並行した書き込みの順番が前後しても古い行は残らない。
+        """
+        if not channel_ids:
+            return
+        try:
+            client = get_redis()
+            pipe = client.pipeline()
+            pipe.delete(*[self._key(channel_id) for channel_id in channel_ids])
+            pipe.zrem(self.index_key, *channel_ids)
+            for channel_id in channel_ids:
+                pipe.incr(self._version_key(channel_id))
+                pipe.expire(self._version_key(channel_id), self.ttl)
+                pipe.publish(GAME_INFO_INVALIDATION_CHANNEL, channel_id)
+            pipe.execute()
+        except redis.RedisError as e:
+            logger.warning("Failed to invalidate game info cache: %s", e)
+
+
+class LocalGameInfoCache:
+    """
+    Bolt(web)プロセス内のgame_infoキャッシュ。
+    ワーカーでの更新はRedisのPub/Sub(GAME_INFO_INVALIDATION_CHANNEL)で受け取り、エントリを破棄する。
+    """
+
+    def __init__(self, ttl=setting.GAME_INFO_CACHE_TTL, maxsize=setting.GAME_INFO_CACHE_MAXSIZE):
+        self.entries = TTLCache(maxsize=maxsize, ttl=ttl)
+        # 破棄のたびに増やす。DBを読んでいる間に破棄があった場合は、読んだ行をキャッシュしない。
+        self.generation = 0
+
+    def get(self, channel_id):
+        return self.entries.get(channel_id)
+
+    def version(self, channel_id):
+        return self.generation
+
+    def set(self, channel_id, game_info: dict, version=None):
+        if version is not None and version != self.generation:
+            return
+        self.entries[channel_id] = game_info
+
+    def invalidate(self, channel_id):
+        self.generation += 1
+        self.entries.pop(channel_id, None)
+
+    async def listen(self, retry_interval=5):
+        while True:
+            # get_async_redis()の接続プールから、購読用の接続を1つ使う。
+            pubsub = get_async_redis().pubsub()
+            try:
+                await pubsub.subscribe(GAME_INFO_INVALIDATION_CHANNEL)
+                # 購読していなかった間の更新は分からないので、全て破棄する。
+                self.generation += 1
+                self.entries.clear()
+                async for message in pubsub.listen():
+                    if message["type"] == "message":
+                        self.invalidate(message["data"])
+            except redis.RedisError as e:
+                logger.warning("Game info invalidation listener disconnected: %s", e)
+            finally:
+                await pubsub.close()
+            await asyncio.sleep(retry_interval)
+
+
+class SharedValueCache:
+    """Redisに保存して、全てのワーカーで共有するJSON値のキャッシュ。"""
+
+    def __init__(self, key, ttl):
+        self.key = key
+        self.ttl = ttl
+
+    def get(self):
+        try:
+            value = get_redis().get(self.key)
+        except redis.RedisError as e:
+            logger.warning("Failed to read %s: %s", self.key, e)
+            return None
+        return None if value is None else json.loads(value)
+
+    def set(self, value):
+        try:
+            get_redis().set(self.key, json.dumps(value), ex=self.ttl)
+        except redis.RedisError as e:
+            logger.warning("Failed to write %s: %s", self.key, e)
+
+    def invalidate(self):
+        try:
+            get_redis().delete(self.key)
+        except redis.RedisError as e:
+            logger.warning("Failed to invalidate %s: %s", self.key, e)
+
+
+class MessageCaptureSession:
+    """
+    webプロセスがmessageイベントを途切れずに受け取っている期間(セッション)をRedisに記録する。
+    webプロセスはSocket Modeで接続している間、session_keyを一定間隔で延長し、切断・再起動のたびに新しいIDにする。
+    ゲーム開始時のセッションIDを記録しておき、エクスポート時に同じセッションが続いていれば、
+    message_logにそのゲームのメッセージが全て記録されているとみなす。
+    """
+    session_key = "message_capture:session"
+    game_key_prefix = "message_capture:game:"
+    # ゲームの記録を残す期間(秒)。切れた場合はconversations_historyから読む。
+    game_ttl = 7 * 24 * 60 * 60
+
+    def __init__(self, ttl=3 * setting.MESSAGE_CAPTURE_HEARTBEAT_INTERVAL):
+        self.ttl = ttl
+
+    async def begin(self):
+        """新しいセッションを始める(webプロセス)。以前のセッションで開始したゲームは、記録が途切れた扱いになる。"""
+        session_id = uuid.uuid4().hex
+        await get_async_redis().set(self.session_key, session_id, ex=self.ttl)
+        logger.info("Started message capture session %s", session_id)
+        return session_id
+
+    async def extend(self, session_id):
+        """セッションを延長する(webプロセス)。期限切れなどで別のセッションになっていればFalse。"""
+        client = get_async_redis()
+        if await client.get(self.session_key) != session_id:
+            return False
+        return bool(await client.expire(self.session_key, self.ttl))
+
+    async def end(self):
+        await get_async_redis().delete(self.session_key)
+
+    def _game_key(self, channel_id):
+        return f"{self.game_key_prefix}{channel_id}"
+
+    def mark_game_started(self, channel_id):
+        """ゲーム開始時のセッションを記録する(ワーカー)。webプロセスが受信していなければ記録しない。"""
+        try:
+            client = get_redis()
+            session_id = client.get(self.session_key)
+            if session_id is None:
+                client.delete(self._game_key(channel_id))
+                logger.warning("Message capture is not running at the start of <#%s>; the dialogue will be read from Slack", channel_id)
+            else:
+                client.set(self._game_key(channel_id), session_id, ex=self.game_ttl)
+        except redis.RedisError as e:
+            logger.warning("Failed to record message capture session for <#%s>: %s", channel_id, e)
+
+    def is_complete(self, channel_id):
+        """ゲーム開始時からセッションが途切れていなければTrue(ワーカー)。"""
+        try:
+            game_session_id, session_id = get_redis().mget(self._game_key(channel_id), self.session_key)
+        except redis.RedisError as e:
+            logger.warning("Failed to read message capture session: %s", e)
+            return False
+        return game_session_id is not None and game_session_id == session_id
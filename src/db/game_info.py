@@ -1,12 +1,41 @@
-from sqlalchemy import create_engine, Column, String, Boolean, Integer
+from sqlalchemy import create_engine, select, delete, Column, String, Boolean, Integer, Text
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 from sqlalchemy.orm import sessionmaker, scoped_session
-import numpy as np
+import numbers
+from collections import namedtuple
 import setting
+from src.db.cache import GameInfoCache, LocalGameInfoCache
+from src.app.metrics import metrics, instrument_methods, CACHE_COMPONENT
 
 Base = declarative_base()
 
 
+def mysql_url(driver="mysqlconnector"):
+    return f"mysql+{driver}://{setting.MYSQL_USER}:{setting.MYSQL_PASSWORD}@{setting.MYSQL_HOST}/{setting.MYSQL_DATABASE}"
+
+
+def database_url(is_async=False):
+    """DATABASE_URL(非同期はASYNC_DATABASE_URL)が設定されていればそれを、なければMySQLのURLを返す。"""
+    url = setting.ASYNC_DATABASE_URL if is_async else setting.DATABASE_URL
+    return url or mysql_url(driver="aiomysql" if is_async else "mysqlconnector")
+
+
+def upsert_statement(dialect_name, table, rows, update_columns):
+    """
+    主キーが重複する行は update_columns を上書きするINSERT文を返す。
+    MySQLは INSERT ... ON DUPLICATE KEY UPDATE、SQLite(ベンチマーク用)は INSERT ... ON CONFLICT DO UPDATE。
+    """
+    if dialect_name == "sqlite":
+        stmt = sqlite_insert(table).values(rows)
+        primary_keys = [column.name for column in table.__table__.primary_key]
+        return stmt.on_conflict_do_update(index_elements=primary_keys, set_={name: stmt.excluded[name] for name in update_columns})
+    stmt = mysql_insert(table).values(rows)
+    return stmt.on_duplicate_key_update({name: stmt.inserted[name] for name in update_columns})
+
+
 class GameInfoTable(Base):
     __tablename__ = "game_info"
 
@@ -26,10 +55,37 @@ class GameInfoTable(Base):
     customer_done = Column(Boolean, default=False)
     sales_done = Column(Boolean, default=False)
 
+    def to_dict(self):
+        return {column.name: getattr(self, column.name) for column in self.__table__.columns}
+
     def __repr__(self):
         return f"<GameInfoTable(channel_id={self.channel_id}, customer_email={self.customer_email}, sales_email={self.sales_email}, customer_id={self.customer_id}, sales_id={self.sales_id}, is_started={self.is_started})>"
 
 
+class MessageLogTable(Base):
+    """Socket Modeのmessageイベントで記録した、客役・営業役のメッセージ。"""
+    __tablename__ = "message_log"
+
+    channel_id = Column(String(255), primary_key=True)
+    # Slackのts("1686000000.123456")。桁数が揃っているので文字列のまま並べ替え・比較できる。
+    ts = Column(String(32), primary_key=True)
+    user_id = Column(String(255))
+    role = Column(String(16))
+    text = Column(Text)
+
+    def __repr__(self):
+        return f"<MessageLogTable(channel_id={self.channel_id}, ts={self.ts}, user_id={self.user_id}, role={self.role})>"
+
+
+# mark_role_doneの結果。changedは指定したroleのフラグがこの呼び出しで立ったか、
+# completedはこの呼び出しで二人とも完了になったか(結果発表を一度だけ行うため)。
+DoneTransition = namedtuple("DoneTransition", ["game_info", "changed", "completed"])
+
+
+@instrument_methods("mysql", [
+    "save_game_infos", "get_existing_channel_ids", "get_is_started", "set_started", "set_judge", "set_worksheet_url",
+    "set_customer_done", "set_sales_done", "mark_role_done", "get_messages", "reset_done",
+])
 class GameInfoDB:
     _instance = None
 
@@ -39,45 +95,79 @@ class GameInfoDB:
             cls._instance = cls()
         return cls._instance
 
-    def __init__(self):
-        db_url = f"mysql+mysqlconnector://{setting.MYSQL_USER}:{setting.MYSQL_PASSWORD}@{setting.MYSQL_HOST}/{setting.MYSQL_DATABASE}"
-        self.engine = create_engine(db_url)
+    def __init__(self, cache=None):
+        self.engine = create_engine(database_url())
         self.session_factory = sessionmaker(bind=self.engine, expire_on_commit=False)
         self.Session = scoped_session(self.session_factory)
-        self.create_table()
+        self.cache = cache if cache is not None else GameInfoCache()
     
 
     def create_table(self):
         Base.metadata.create_all(self.engine)
 
+    def _game_info_values(self, game_info: dict):
+        columns = GameInfoTable.__table__.columns
+        unknown = set(game_info) - set(columns.keys())
+        if unknown:
+            raise TypeError(f"Unknown game info fields: {unknown}")
+
+        # 再登録時は、指定されていないカラムをデフォルト値に戻す(delete+insertと同じ結果にする)。
+        values = {}
+        for column in columns:
+            value = game_info.get(column.name, column.default.arg if column.default is not None else None)
+            # pandas経由の値(np.int64など)はPythonのintに戻す。
+            if isinstance(value, numbers.Integral) and not isinstance(value, (int, bool)):
+                value = int(value)
+            values[column.name] = value
+        return values
+
     def save_game_info(self, **kwargs):
+        return self.save_game_infos([kwargs])[0]
+
+    def save_game_infos(self, game_infos: list):
+        """複数チャンネルのgame_infoを、INSERT ... ON DUPLICATE KEY UPDATEの1文でまとめて登録する。"""
+        rows = [self._game_info_values(game_info) for game_info in game_infos]
+        if not rows:
+            return []
+
+        stmt = upsert_statement(self.engine.dialect.name, GameInfoTable, rows, [name for name in rows[0] if name != "channel_id"])
+        session = self.Session()
         try:
-            for key, value in kwargs.items():
-                if isinstance(value, np.int64):
-                    kwargs[key] = int(value)
-                    
-            session = self.Session()
-            channel_id = kwargs.get('channel_id')
-            game_info = session.query(GameInfoTable).filter_by(channel_id=channel_id).first()
-            if game_info:
-                # If a record with the given channel_id exists, delete it
-                session.delete(game_info)
-            game_info = GameInfoTable(**kwargs)
-            session.add(game_info)
+            session.execute(stmt)
             session.commit()
-            self.Session.remove()
-            return game_info
-        except Exception as e:
+        except Exception:
             session.rollback()
-            return e
+            raise
         finally:
             self.Session.remove()
-            
+
+        self.cache.invalidate(*[row["channel_id"] for row in rows])
+        return [GameInfoTable(**row) for row in rows]
+
     def get_game_info(self, channel_id):
+        cached = self.cache.get(channel_id)
+        metrics.count(CACHE_COMPONENT, "game_info_redis:hit" if cached is not None else "game_info_redis:miss")
+        if cached is not None:
+            return GameInfoTable(**cached)
+        version = self.cache.version(channel_id)
+        # キャッシュのヒットをMySQLの呼び出しとして数えないよう、クエリの部分だけを計測する。
+        with metrics.timed("mysql", "get_game_info"):
+            session = self.Session()
+            game_info = session.query(GameInfoTable).filter_by(channel_id=channel_id).first()
+            self.Session.remove()
+        # versionが取れなかった(Redisが使えない)場合は、キャッシュしない。
+        if game_info is not None and version is not None:
+            self.cache.set(channel_id, game_info.to_dict(), version=version)
+        return game_info
+
+    def get_existing_channel_ids(self, channel_ids) -> set:
+        """channel_idsのうち、game_infoが既に登録されているチャンネルIDの集合を1回のSELECTで返す。"""
+        if not channel_ids:
+            return set()
         session = self.Session()
-        game_info = session.query(GameInfoTable).filter_by(channel_id=channel_id).first()
+        rows = session.query(GameInfoTable.channel_id).filter(GameInfoTable.channel_id.in_(list(channel_ids))).all()
         self.Session.remove()
-        return game_info
+        return {row.channel_id for row in rows}
 
     def get_is_started(self, channel_id):
         session = self.Session()
@@ -90,18 +180,21 @@ class GameInfoDB:
         session.query(GameInfoTable).filter_by(channel_id=channel_id).update({"is_started": True})
         session.commit()
         self.Session.remove()
+        self.cache.invalidate(channel_id)
     
     def set_judge(self, channel_id, judge):
         session = self.Session()
         session.query(GameInfoTable).filter_by(channel_id=channel_id).update({"judge": judge})
         session.commit()
         self.Session.remove()
+        self.cache.invalidate(channel_id)
     
     def set_worksheet_url(self, channel_id, worksheet_url):
         session = self.Session()
         session.query(GameInfoTable).filter_by(channel_id=channel_id).update({"worksheet_url": worksheet_url})
         session.commit()
         self.Session.remove()
+        self.cache.invalidate(channel_id)
     
     def set_customer_done(self, channel_id, undo=False):
         session = self.Session()
@@ -111,6 +204,7 @@ class GameInfoDB:
             session.query(GameInfoTable).filter_by(channel_id=channel_id).update({"customer_done": True})
         session.commit()
         self.Session.remove()
+        self.cache.invalidate(channel_id)
     
     def set_sales_done(self, channel_id, undo=False):
         session = self.Session()
@@ -119,4 +213,125 @@ class GameInfoDB:
         else:
             session.query(GameInfoTable).filter_by(channel_id=channel_id).update({"sales_done": True})
         session.commit()
-        self.Session.remove()
\ No newline at end of file
+        self.Session.remove()
+        self.cache.invalidate(channel_id)
+
+    def mark_role_done(self, channel_id, role, auto_sales_done=False):
+        """
+        role("customer" | "sales")の完了フラグを立て、更新後の状態を返す。
+        行ロック(SELECT ... FOR UPDATE)を取った1トランザクションで行うので、二人が同時に完了しても
+        completedがTrueになるのはどちらか一方だけ。
+
+        Args:
+            channel_id (str): ゲームのチャンネルID
+            role (str or None): 完了にする役。Noneの場合は何も完了にしない。
+            auto_sales_done (bool): 営業役が詐欺師でない場合など、営業役も合わせて完了にするか。
+
+        Returns:
+            DoneTransition: (game_info, changed, completed)
+        """
+        session = self.Session()
+        try:
+            game_info = session.query(GameInfoTable).filter_by(channel_id=channel_id).with_for_update().first()
+            if game_info is None:
+                session.rollback()
+                return DoneTransition(None, False, False)
+
+            was_completed = game_info.customer_done and game_info.sales_done
+            changed = False
+            if role is not None and not getattr(game_info, f"{role}_done"):
+                setattr(game_info, f"{role}_done", True)
+                changed = True
+            if auto_sales_done:
+                game_info.sales_done = True
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            self.Session.remove()
+
+        self.cache.invalidate(channel_id)
+        completed = not was_completed and game_info.customer_done and game_info.sales_done
+        return DoneTransition(game_info, changed, completed)
+
+    def get_messages(self, channel_id, oldest=None):
+        """記録済みのメッセージをts順に返す。oldestを指定した場合は、それより新しいものだけ。"""
+        session = self.Session()
+        query = session.query(MessageLogTable).filter_by(channel_id=channel_id)
+        if oldest is not None:
+            query = query.filter(MessageLogTable.ts > oldest)
+        messages = query.order_by(MessageLogTable.ts).all()
+        self.Session.remove()
+        return messages
+
+    def reset_done(self, channel_id):
+        """客役・営業役の完了フラグを1回のUPDATEで両方とも戻す。"""
+        session = self.Session()
+        session.query(GameInfoTable).filter_by(channel_id=channel_id).update({"customer_done": False, "sales_done": False})
+        session.commit()
+        self.Session.remove()
+        self.cache.invalidate(channel_id)
+
+
+class AsyncGameInfoDB:
+    """Bolt(asyncio)のハンドラから使う、GameInfoDBの非同期版。ワーカーは同期版のGameInfoDBを使う。"""
+    _instance = None
+
+    @classmethod
+    def get_instance(cls):
+        if cls._instance is None:
+            cls._instance = cls()
+        return cls._instance
+
+    def __init__(self, cache=None):
+        url = database_url(is_async=True)
+        pool_options = dict(
+            pool_size=setting.MYSQL_POOL_SIZE,
+            max_overflow=setting.MYSQL_MAX_OVERFLOW,
+            pool_timeout=setting.MYSQL_POOL_TIMEOUT,
+            pool_recycle=setting.MYSQL_POOL_RECYCLE,
+            pool_pre_ping=True,
+        )
+        # SQLite(ベンチマーク用)はSQLAlchemyのデフォルトのプールを使う。
+        self.engine = create_async_engine(url, **({} if url.startswith("sqlite") else pool_options))
+        self.Session = async_sessionmaker(bind=self.engine, expire_on_commit=False)
+        self.cache = cache if cache is not None else LocalGameInfoCache()
+
+    async def create_table(self):
+        async with self.engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+
+    async def dispose(self):
+        await self.engine.dispose()
+
+    async def get_game_info(self, channel_id):
+        cached = self.cache.get(channel_id)
+        metrics.count(CACHE_COMPONENT, "game_info_local:hit" if cached is not None else "game_info_local:miss")
+        if cached is not None:
+            return GameInfoTable(**cached)
+        version = self.cache.version(channel_id)
+        async with self.Session() as session:
+            result = await session.execute(select(GameInfoTable).filter_by(channel_id=channel_id))
+            game_info = result.scalars().first()
+        if game_info is not None:
+            self.cache.set(channel_id, game_info.to_dict(), version=version)
+        return game_info
+
+    async def get_is_started(self, channel_id):
+        async with self.Session() as session:
+            result = await session.execute(select(GameInfoTable.is_started).filter_by(channel_id=channel_id))
+            return result.first()
+
+    async def save_message(self, channel_id, ts, user_id, role, text):
+        """メッセージを記録する。編集された場合(同じts)は本文を更新する。"""
+        row = dict(channel_id=channel_id, ts=ts, user_id=user_id, role=role, text=text)
+        stmt = upsert_statement(self.engine.dialect.name, MessageLogTable, [row], ["text"])
+        async with self.Session() as session:
+            await session.execute(stmt)
+            await session.commit()
+
+    async def delete_message(self, channel_id, ts):
+        async with self.Session() as session:
+            await session.execute(delete(MessageLogTable).filter_by(channel_id=channel_id, ts=ts))
+            await session.commit()